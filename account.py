@@ -0,0 +1,131 @@
+'''
+File: account.py
+Author: Nathan Hoad
+Description: Everything needed to watch one mailbox of one email account
+'''
+
+import logging
+
+from auth import Authenticator
+from dispatch import Dispatcher
+from emails import MailHandler
+from ledger import Ledger
+from outbox import Outbox
+
+
+class Account(object):
+    def __init__(self, name, mailbox, settings, patterns):
+        """Initialise an Account watching mailbox, with its own connections, ledger and outbox.
+
+        Keyword arguments:
+        name -- name of the [account NAME] section, or '' for the account in [settings].
+        mailbox -- IMAP folder to watch.
+        settings -- Settings for the account.
+        patterns -- list of (pattern, script, timeout, warm) rules for commands sent to it.
+
+        """
+        self.name = name
+        self.mailbox = mailbox
+        # the main account's inbox keeps the ledger entries it had before there could be more than one.
+        self.source = '' if not name and mailbox == 'INBOX' else '{}/{}'.format(name, mailbox)
+        self.settings = settings
+        self.patterns = patterns
+        self.dispatcher = Dispatcher(patterns)
+        self.authenticator = self.new_authenticator()
+        self.mail_handler = self.new_mailhandler()
+        self.ledger = Ledger(settings.ledger_file, self.source)
+        self.outbox = Outbox(settings.ledger_file, self.mail_handler, self.ledger, settings.reply_batch_size,
+                settings.reply_retry_delay, settings.reply_retry_max, settings.reply_attempts, settings.reply_coalesce)
+        # the MessageProcessor of the last check, and the last one whose results were passed to the schedule.
+        self.processor = self.observed = None
+
+    def __repr__(self):
+        """Return the account and mailbox, for log messages."""
+        return '{}/{}'.format(self.name or self.settings.username, self.mailbox)
+
+    def authorised(self, message):
+        """Return True if message's sender may run commands, logging why not if they can't.
+
+        Keyword arguments:
+        message -- Email object to check.
+
+        """
+        reason = self.authenticator.check(message)
+
+        if reason is not None:
+            logging.warning('Rejected message from {} to {}: {}'.format(message.sender, self, reason))
+            return False
+
+        return True
+
+    def close(self):
+        """Stop sending replies and close the connections and ledger."""
+        self.outbox.close()
+        self.mail_handler.close()
+        self.ledger.close()
+
+    def new_authenticator(self, settings=None):
+        """Return a new Authenticator for commands sent to the account.
+
+        Keyword arguments:
+        settings -- Settings to use instead of the account's own.
+
+        """
+        s = settings or self.settings
+
+        return Authenticator(s.allowed_senders, s.auth_servers, s.require_dkim, s.auth_secret, s.auth_window)
+
+    def new_mailhandler(self, settings=None):
+        """Return a new MailHandler for the mailbox.
+
+        Keyword arguments:
+        settings -- Settings to use instead of the account's own.
+
+        """
+        s = settings or self.settings
+
+        return MailHandler(s.username, s.password, s.smtp_server, s.smtp_port, s.imap_server, s.imap_port, s.imap_ssl, s.smtp_tls,
+                s.reconnect_attempts, s.reconnect_delay, s.fetch_chunk_size, s.preview_size, s.spool_dir or None, self.mailbox,
+                s.search_from, s.search_subject, s.search_since)
+
+    def update(self, settings, patterns, dispatcher):
+        """Swap in new settings and rules. Return True if the login details changed and new connections are used.
+
+        Commands that are already running finish with what they started
+        with. Anything still using the old connections keeps them until it's
+        done, then they're logged out when collected.
+
+        Keyword arguments:
+        settings -- new Settings for the account.
+        patterns -- new list of rules.
+        dispatcher -- Dispatcher compiled from patterns.
+
+        """
+        old = self.mail_handler
+        mail_handler = self.new_mailhandler(settings)
+        reconnect = (mail_handler.username, mail_handler.password, mail_handler.imap_details, mail_handler.smtp_details) != \
+                (old.username, old.password, old.imap_details, old.smtp_details)
+
+        if reconnect:
+            logging.info('Login details for {} changed, reconnecting'.format(self))
+            self.mail_handler = self.outbox.mail_handler = mail_handler
+        else:
+            for name in ('reconnect_attempts', 'reconnect_delay', 'fetch_chunk_size', 'preview_size', 'spool_dir', 'search_from',
+                    'search_subject', 'search_since'):
+                setattr(old, name, getattr(mail_handler, name))
+
+        self.settings = settings
+        self.patterns = patterns
+        self.dispatcher = dispatcher
+        self.authenticator = self.new_authenticator(settings)
+
+        return reconnect
+
+    def wanted(self, message):
+        """Return True if any pattern matches message, meaning it's worth downloading in full.
+
+        Keyword arguments:
+        message -- Email object to check, possibly only a preview of the real message.
+
+        """
+        return self.dispatcher.match(message) is not None
@@ -0,0 +1,155 @@
+'''
+File: auth.py
+Author: Nathan Hoad
+Description: Decides whether a message's sender is allowed to run commands
+'''
+
+import hashlib
+import hmac
+import re
+import sys
+import threading
+import time
+
+from email.utils import parseaddr
+
+
+class Authenticator(object):
+    # comments in Authentication-Results, which may contain ; and = but mean nothing.
+    COMMENT = re.compile(r'\([^()]*\)')
+    # the line in a message's body carrying the time it was signed and its HMAC token.
+    TOKEN = re.compile(r'^\s*token\s+(\d+)\s+([0-9a-f]+)\s*$', re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self, allowed_senders=(), auth_servers=(), require_dkim=False, secret='', window=900):
+        """Initialise an Authenticator, which checks messages before any script is run for them.
+
+        Every check that's configured must pass. With none configured, every
+        message is allowed, as before.
+
+        Keyword arguments:
+        allowed_senders -- addresses, or @domains, that may send commands. Empty allows anyone.
+        auth_servers -- authserv-ids of the mail servers whose Authentication-Results headers are trusted.
+        require_dkim -- whether a trusted server must have passed DKIM or DMARC for the sender's domain.
+        secret -- key for the HMAC-SHA256 of the time, subject and body, which must be in the body as token TIME HEX.
+        Empty means no token is needed.
+        window -- most seconds a token's time can be from now. Tokens are only accepted once within it.
+
+        """
+        self.allowed_senders = set(sender.lower() for sender in allowed_senders)
+        self.auth_servers = set(server.lower() for server in auth_servers)
+        self.require_dkim = require_dkim
+        self.secret = secret.encode('utf-8')
+        self.window = window
+        # tokens already accepted, and when they stop being valid anyway.
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def _allowed(self, address):
+        """Return True if address, or its domain, is in allowed_senders."""
+        domain = '@' + address.rpartition('@')[2]
+        return address in self.allowed_senders or domain in self.allowed_senders
+
+    def _authenticated(self, message, domain):
+        """Return True if a trusted server passed DKIM or DMARC for domain, according to the message's headers.
+
+        Only the topmost header from a trusted server counts, since that's
+        the one added by the receiving server. Anything below it came with
+        the message and could have been written by the sender.
+
+        """
+        for header in message.authentication_results:
+            header = self.COMMENT.sub(' ', header)
+            parts = [part.split() for part in header.split(';')]
+
+            if parts[0] and parts[0][0].lower() in self.auth_servers:
+                break
+        else:
+            return False
+
+        for part in parts[1:]:
+            if not part:
+                continue
+
+            method, _, result = part[0].lower().partition('=')
+
+            if result != 'pass' or method not in ('dkim', 'dmarc'):
+                continue
+
+            properties = dict(p.lower().partition('=')[::2] for p in part[1:])
+            signer = properties.get('header.d') or properties.get('header.from') or properties.get('header.i', '')
+
+            if signer.rpartition('@')[2] == domain:
+                return True
+
+        return False
+
+    def _replayed(self, token, now):
+        """Return True if token has been accepted before, otherwise remember it until it's too old to use."""
+        with self._lock:
+            for old, expires in list(self._used.items()):
+                if expires < now:
+                    del self._used[old]
+
+            if token in self._used:
+                return True
+
+            self._used[token] = now + 2 * self.window
+            return False
+
+    def _signed_text(self, timestamp, subject, body):
+        """Return the bytes a token signs: the time, subject and body without its token line.
+
+        Line endings and trailing spaces are ignored, since mail clients
+        and servers often change them.
+
+        """
+        lines = [line.rstrip() for line in body.replace('\r\n', '\n').split('\n') if not self.TOKEN.match(line)]
+        return '{}\n{}\n{}'.format(timestamp, subject.strip(), '\n'.join(lines).strip('\n')).encode('utf-8')
+
+    def token(self, timestamp, subject, body):
+        """Return the token a message with subject and body, signed at timestamp, needs in its body."""
+        return hmac.new(self.secret, self._signed_text(timestamp, subject, body), hashlib.sha256).hexdigest()
+
+    def check(self, message):
+        """Return why message may not run commands, or None if it may.
+
+        Keyword arguments:
+        message -- Email object to check, with its Authentication-Results headers.
+
+        """
+        address = parseaddr(message.sender or '')[1].lower()
+
+        if self.allowed_senders and not self._allowed(address):
+            return 'sender is not in allowed_senders'
+
+        if self.require_dkim and not (address and self._authenticated(message, address.rpartition('@')[2])):
+            return 'no trusted Authentication-Results passing DKIM for the sender'
+
+        if self.secret:
+            found = self.TOKEN.search(message.body or '')
+
+            if found is None:
+                return 'no token in the body'
+
+            timestamp, token = int(found.group(1)), found.group(2).lower()
+            now = time.time()
+
+            if not hmac.compare_digest(token, self.token(timestamp, message.subject or '', message.body)):
+                return 'wrong token'
+
+            if abs(now - timestamp) > self.window:
+                return 'token is too old'
+
+            if self._replayed(token, now):
+                return 'token has already been used'
+
+        return None
+
+
+if __name__ == '__main__':
+    # print the token line for a command, e.g. python3 auth.py SECRET 'SUBJECT' < body.txt
+    if len(sys.argv) != 3:
+        sys.exit('usage: {} SECRET SUBJECT < BODY'.format(sys.argv[0]))
+
+    timestamp = int(time.time())
+    print('token {} {}'.format(timestamp, Authenticator(secret=sys.argv[1]).token(timestamp, sys.argv[2], sys.stdin.read())))
@@ -0,0 +1,73 @@
+'''
+File: dispatch.py
+Author: Nathan Hoad
+Description: Matches emails against the [scripts] patterns
+'''
+
+import logging
+import re
+
+
+class Dispatcher(object):
+    # backreferences are numbered, so they'd point at the wrong group once patterns are combined.
+    BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+    def __init__(self, rules):
+        """Compile rules once, so matching a message is a single regex call per field.
+
+        Rules are tried in order and the first one to match wins, exactly as if
+        each pattern were searched for in turn.
+
+        Keyword arguments:
+        rules -- list of rule tuples, each starting with its pattern, as read from [scripts].
+
+        Raises re.error if any pattern is invalid.
+
+        """
+        self.rules = list(rules)
+        self._compiled = []
+
+        for rule in self.rules:
+            try:
+                self._compiled.append(re.compile(rule[0], re.IGNORECASE))
+            except re.error as e:
+                raise re.error('invalid pattern {!r} for {}: {}'.format(rule[0], rule[1], e))
+
+        self._combined = None
+
+        if self.rules and not any(self.BACKREFERENCE.search(rule[0]) for rule in self.rules):
+            # each rule is a lookahead from the start of the text, so the
+            # alternation picks the first rule that matches anywhere.
+            alternatives = ['(?=[\\s\\S]*?(?P<rule{}>{}))'.format(i, rule[0]) for i, rule in enumerate(self.rules)]
+
+            try:
+                self._combined = re.compile(r'\A(?:{})'.format('|'.join(alternatives)), re.IGNORECASE)
+            except re.error as e:
+                logging.debug('Could not combine patterns, matching them one at a time: {}'.format(e))
+
+    def _first_rule(self, text):
+        """Return the index of the first rule matching text, or None."""
+        if self._combined is not None:
+            result = self._combined.match(text)
+            return int(result.lastgroup[4:]) if result else None
+
+        for i, pattern in enumerate(self._compiled):
+            if pattern.search(text):
+                return i
+
+        return None
+
+    def match(self, message):
+        """Return the first rule matching message, or None if nothing matches.
+
+        Keyword arguments:
+        message -- Email object to check the subject and body of.
+
+        """
+        matches = [self._first_rule(text) for text in (message.subject or '', message.body or '')]
+        matches = [i for i in matches if i is not None]
+
+        if not matches:
+            return None
+
+        return self.rules[min(matches)]
@@ -4,26 +4,33 @@ Author: Nathan Hoad
 Description: Holds email handling classes
 '''
 
+import base64
+import binascii
 import logging
 import email
+import email.policy
 import smtplib
 import imaplib
 import re
+import select
+import shutil
 import time
 import os
 import sys
 import tempfile
+import threading
 import traceback
 import socket
+import ssl
 
 from smtplib import SMTPAuthenticationError
-from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.parser import HeaderParser
 from email.utils import formatdate
 
+from ledger import Ledger
+
 
 class Email(object):
     def __init__(self, sender=None, receiver=None, subject=None, body=None):
@@ -41,6 +48,10 @@ class Email(object):
         self.subject = subject
         self.body = body
         self.files = []
+        self.uid = self.uidvalidity = None
+        self.spool = None
+        # Authentication-Results headers of a received message, newest first.
+        self.authentication_results = []
 
         if isinstance(receiver, list):
             self.receiver = receiver
@@ -63,6 +74,12 @@ class Email(object):
 
         self.files.append((filename, filepath))
 
+    def cleanup(self):
+        """Delete the directory received attachments were saved in, along with anything left in it."""
+        if self.spool is not None:
+            shutil.rmtree(self.spool, ignore_errors=True)
+            self.spool = None
+
     def __repr__(self):
         """Nice formatted output."""
         return 'Email(receiver={0}, sender={1}, subject={2}, body={3})'.format(self.receiver, self.sender, self.subject, self.body)
@@ -74,12 +91,23 @@ class Email(object):
         pattern -- string/regex to search for.
 
         """
-        p = r'%s'.lower() % pattern
-        return re.search(p, self.subject.lower()) or re.search(p, self.body.lower())
+        return re.search(pattern, self.subject, re.IGNORECASE) or re.search(pattern, self.body, re.IGNORECASE)
 
 class MailHandler(object):
-    def __init__(self, username, password, smtp_server, smtp_port, imap_server, imap_port, use_ssl, use_tls):
-        """Set the username, password, SMTP and IMAP info, and log in.
+    # RFC 2177 says servers may drop an IDLE after 30 minutes of silence.
+    IDLE_TIMEOUT = 29 * 60
+    # how often an IDLE wakes up to check whether it should stop.
+    IDLE_TICK = 1
+    # characters of base64 to decode at a time when saving attachments.
+    DECODE_CHUNK_SIZE = 65536
+    # bytes of an attachment to encode at a time when sending; a multiple of 57 keeps base64 lines whole.
+    ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+    def __init__(self, username, password, smtp_server, smtp_port, imap_server, imap_port, use_ssl, use_tls, reconnect_attempts=5, reconnect_delay=2, fetch_chunk_size=50, preview_size=16384, spool_dir=None, mailbox='INBOX', search_from=(), search_subject=(), search_since=0):
+        """Set the username, password, SMTP and IMAP info.
+
+        Connections aren't opened until they're first needed, and are then
+        kept open and reused until close() is called.
 
         Keyword arguments:
         username -- username to log into IMAP and SMTP
@@ -90,36 +118,96 @@ class MailHandler(object):
         imap_port -- port of IMAP server
         use_ssl -- boolean for whether to use ssl or not to connect to IMAP
         use_tls -- boolean for whether to use tls or not to connect to SMTP
+        reconnect_attempts -- how many times to retry a lost connection before giving up
+        reconnect_delay -- seconds to wait before the first retry, doubling on each retry after that
+        fetch_chunk_size -- most messages to download in a single FETCH command
+        preview_size -- bytes of text to download when previewing a message. 0 always downloads messages in full.
+        spool_dir -- directory to save attachments under, one subdirectory per message. None uses the system default.
+        mailbox -- IMAP folder to watch for messages.
+        search_from -- if given, only messages from an address containing one of these are fetched.
+        search_subject -- if given, only messages with a subject containing one of these are fetched.
+        search_since -- if more than 0, only messages from the last search_since days are fetched.
 
         """
         self.username = username
         self.password = password
         self.imap_details = (imap_server, imap_port, use_ssl)
         self.smtp_details = (smtp_server, smtp_port, use_tls)
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.fetch_chunk_size = fetch_chunk_size
+        self.preview_size = preview_size
+        self.spool_dir = spool_dir
+        self.mailbox = mailbox
+        self.search_from = search_from
+        self.search_subject = search_subject
+        self.search_since = search_since
         self.error = False
         self.imap = self.smtp = None
-
-        try:
-            self._login_imap()
-            self._login_smtp()
-        except (imaplib.IMAP4.error, socket.gaierror) as e:
-            self.error = True
-            logging.critical('IMAP error: ' + str(e))
-        except smtplib.SMTPAuthenticationError as e:
-            self.error = True
-            logging.critical('SMTP error: ' + str(e))
+        self.message_count = None
+        self.uidvalidity = None
+        self.lock = threading.RLock()
+        # replies are sent from several workers at once, but share one SMTP connection.
+        self.smtp_lock = threading.Lock()
 
     def __del__(self):
         """Clean up resources. Logs out IMAP and SMTP clients."""
-        if self.imap:
-            logging.debug('Logging out IMAP')
-            self.imap.logout()
-            logging.debug('IMAP logged out')
+        self.close()
 
-        if self.smtp:
-            logging.debug('Logging out SMTP')
-            self.smtp.quit()
-            logging.debug('SMTP logged out')
+    def _connect(self, name, login, check):
+        """Return a live connection, logging in again with backoff if it has been lost.
+
+        Returns None if the connection couldn't be made.
+
+        Keyword arguments:
+        name -- attribute holding the connection, either 'imap' or 'smtp'.
+        login -- function that logs in and sets the attribute.
+        check -- function that raises if the connection passed to it is dead.
+
+        """
+        connection = getattr(self, name)
+
+        if connection is not None:
+            try:
+                check(connection)
+                return connection
+            except (imaplib.IMAP4.error, OSError) as e:
+                logging.info('{} connection lost, reconnecting: {}'.format(name.upper(), e))
+                setattr(self, name, None)
+
+        for attempt in range(self.reconnect_attempts + 1):
+            if attempt:
+                time.sleep(self.reconnect_delay * 2 ** (attempt - 1))
+
+            try:
+                login()
+                self.error = False
+                return getattr(self, name)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                # SMTP exceptions are OSErrors too, but bad credentials won't fix themselves.
+                if isinstance(e, smtplib.SMTPAuthenticationError):
+                    logging.critical('SMTP error: ' + str(e))
+                    break
+
+                logging.error('{} error: {}'.format(name.upper(), e))
+            except imaplib.IMAP4.error as e:
+                logging.critical('IMAP error: ' + str(e))
+                break
+
+            setattr(self, name, None)
+
+        setattr(self, name, None)
+        self.error = True
+        logging.critical('Could not connect to {}'.format(name.upper()))
+
+        return None
+
+    def _check_smtp(self, smtp):
+        """Raise SMTPServerDisconnected if smtp doesn't respond to a NOOP."""
+        code, message = smtp.noop()
+
+        if code != 250:
+            raise smtplib.SMTPServerDisconnected('NOOP returned {}'.format(code))
 
     def _login_imap(self):
         """Log in to the IMAP server. Set self.imap to the connection object."""
@@ -129,7 +217,14 @@ class MailHandler(object):
 
         self.imap = imaplib.IMAP4_SSL(server, port) if secure else imaplib.IMAP4(server, port)
         self.imap.login(self.username, self.password)
-        self.imap.select()
+
+        code, data = self.imap.select(self._quote(self.mailbox))
+
+        if code != 'OK':
+            raise imaplib.IMAP4.error('could not select {}: {}'.format(self.mailbox, data))
+
+        code, data = self.imap.response('UIDVALIDITY')
+        self.uidvalidity = int(data[-1]) if data[-1] else 0
 
         logging.debug('IMAP logged in')
 
@@ -150,95 +245,647 @@ class MailHandler(object):
 
         logging.debug('SMTP logged in')
 
-    def get_messages(self):
-        """Return a list of Email objects."""
+    def close(self):
+        """Log out the IMAP and SMTP clients, if they're connected."""
+        if self.imap:
+            logging.debug('Logging out IMAP')
+
+            try:
+                self.imap.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+            self.imap = None
+            logging.debug('IMAP logged out')
+
+        if self.smtp:
+            logging.debug('Logging out SMTP')
+
+            try:
+                self.smtp.quit()
+            except OSError:
+                pass
+
+            self.smtp = None
+            logging.debug('SMTP logged out')
+
+    def imap_connection(self):
+        """Return a logged in IMAP connection, or None if one couldn't be made."""
+        return self._connect('imap', self._login_imap, lambda imap: imap.noop())
+
+    def smtp_connection(self):
+        """Return a logged in SMTP connection, or None if one couldn't be made."""
+        return self._connect('smtp', self._login_smtp, self._check_smtp)
+
+    def _update_message_count(self, exists):
+        """Record the latest EXISTS count. Return True if it changed since the last one seen.
+
+        Keyword arguments:
+        exists -- list of EXISTS counts as returned by the server, oldest first.
+
+        """
+        if not exists:
+            return False
+
+        count = int(exists[-1])
+        changed = self.message_count is not None and count != self.message_count
+        self.message_count = count
+
+        return changed
+
+    def supports_idle(self):
+        """Return True if the IMAP server advertises the IDLE capability."""
+        imap = self.imap_connection()
+
+        if imap is None:
+            return False
+
+        status, data = imap.capability()
+
+        if status != 'OK':
+            return False
+
+        capabilities = str(data[0], encoding='utf8').upper().split()
+        return 'IDLE' in capabilities
+
+    def _buffered(self, imap):
+        """Return True if imap has data waiting that was read from the socket but not used yet.
+
+        Keyword arguments:
+        imap -- IMAP connection to check.
+
+        """
+        sock = imap.socket()
+
+        # decrypted data the SSL layer is holding on to.
+        if getattr(sock, 'pending', lambda: 0)():
+            return True
+
+        # peek only reads the socket if its buffer is empty, so without blocking it returns nothing rather than waiting.
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+
+        try:
+            return bool(imap.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def idle(self, timeout=IDLE_TIMEOUT, running=None):
+        """Wait in IMAP IDLE until new mail arrives. Return True if it did, False on timeout.
+
+        Keyword arguments:
+        timeout -- maximum number of seconds to idle for. Capped at IDLE_TIMEOUT.
+        running -- optional function returning False when the wait should be abandoned.
+
+        """
+        # connecting does a NOOP, which reports anything that arrived since the last IDLE.
+        imap = self.imap_connection()
+
+        if imap is None:
+            raise imaplib.IMAP4.abort('could not connect to IMAP')
+
+        if self._update_message_count(imap.untagged_responses.pop('EXISTS', [])):
+            logging.debug('Mailbox changed before IDLE started')
+            return True
+
+        tag = imap._new_tag()
+        imap.send(tag + b' IDLE\r\n')
+
+        response = imap.readline()
+
+        if not response.startswith(b'+'):
+            raise imaplib.IMAP4.error('IDLE rejected: {}'.format(response))
+
+        logging.debug('IMAP idling')
+
+        deadline = time.monotonic() + min(timeout, self.IDLE_TIMEOUT)
+        new_mail = False
+
+        while not new_mail and time.monotonic() < deadline:
+            if running is not None and not running():
+                break
+
+            # lines that came in with the continuation are already in imaplib's buffer, and select can't see them.
+            if not self._buffered(imap):
+                readable, _, _ = select.select([imap.socket()], [], [], self.IDLE_TICK)
+
+                if not readable:
+                    continue
+
+            line = imap.readline()
+
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed during IDLE')
+
+            line = line.rstrip(b'\r\n')
+            logging.debug('IDLE response: {}'.format(line))
+
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(str(line, encoding='utf8', errors='replace'))
+
+            if line.startswith(b'* ') and line.upper().endswith(b' EXISTS'):
+                new_mail = self._update_message_count([line.split()[1]])
+
+        imap.send(b'DONE\r\n')
+
+        while True:
+            line = imap.readline()
+
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed while ending IDLE')
+
+            if line.startswith(tag + b' '):
+                break
+
+        logging.debug('IMAP IDLE finished, new mail: {}'.format(new_mail))
+        return new_mail
+
+    def get_messages(self, wanted=None, ledger=None):
+        """Return a list of Email objects. The list is empty if IMAP can't be reached.
+
+        If wanted is given and previews are enabled, only the headers and the
+        start of each message's text are downloaded at first. Messages wanted
+        doesn't accept are marked as read and left out, and the rest are only
+        downloaded in full if their preview was cut short.
+
+        If ledger is given, new messages are those with a higher UID than any
+        it has recorded, plus any it recorded as fetched but never executed,
+        rather than those without the \\Seen flag.
+
+        Keyword arguments:
+        wanted -- optional function taking a preview Email, returning True if the message should be acted on.
+        ledger -- optional Ledger to find and record new messages with.
+
+        """
+        with self.lock:
+            imap = self.imap_connection()
+
+            if imap is None:
+                return []
+
+            try:
+                return self._fetch_new(imap, wanted, ledger)
+            except imaplib.IMAP4.abort as e:
+                logging.error('IMAP connection lost while fetching messages: {}'.format(e))
+                self.imap = None
+                return []
+
+    def _fetch(self, imap, uids, query):
+        """Fetch query for each uid, in chunks of fetch_chunk_size. Yield a (uid, meta, parts) tuple per message.
+
+        meta is every non-literal piece of the response for the message, and
+        parts maps item names like b'RFC822' or b'BODY[HEADER]' to their data.
+
+        Keyword arguments:
+        imap -- logged in IMAP connection to fetch from.
+        uids -- list of UIDs, as bytes.
+        query -- parenthesised list of items to fetch.
+
+        """
+        size = self.fetch_chunk_size
+
+        for i in range(0, len(uids), size):
+            status, response = imap.uid('FETCH', b','.join(uids[i:i + size]), query)
+
+            if status != 'OK':
+                logging.error('UID FETCH failed: {}'.format(response))
+                continue
+
+            messages = []
+
+            for item in response:
+                # literals come back as (prefix, data) tuples, everything else as plain bytes.
+                prefix, data = item if isinstance(item, tuple) else (item, None)
+
+                if re.match(rb'\d+ \(', prefix):
+                    messages.append([b'', {}])
+                elif not messages:
+                    continue
+
+                messages[-1][0] += prefix
+
+                if data is not None:
+                    name = re.search(rb'([^\s(]+) \{\d+\}$', prefix).group(1)
+                    # partial fetches are named with their origin, e.g. BODY[TEXT]<0>
+                    messages[-1][1][re.sub(rb'<\d+>$', b'', name).upper()] = data
+
+            for meta, parts in messages:
+                result = re.search(rb'UID (\d+)', meta)
+
+                # unsolicited FETCH responses, e.g. flag changes, carry no data.
+                if result and parts:
+                    yield int(result.group(1)), meta, parts
+
+    def _criteria(self):
+        """Return the SEARCH keys that narrow down which messages are fetched, with a leading space, or ''.
+
+        The server does the filtering, so messages that could never be
+        commands aren't downloaded at all.
+
+        """
+        criteria = ''
+
+        for key, values in (('FROM', self.search_from), ('SUBJECT', self.search_subject)):
+            if values:
+                # SEARCH keys are ANDed together, so a choice of values needs an OR for each extra one.
+                criteria += ' ' + 'OR ' * (len(values) - 1) + ' '.join('{} {}'.format(key, self._quote(value)) for value in values)
+
+        if self.search_since:
+            since = time.localtime(time.time() - self.search_since * 86400)
+            # the month has to be in English, whatever the locale.
+            month = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')[since.tm_mon - 1]
+            criteria += ' SINCE {}-{}-{}'.format(since.tm_mday, month, since.tm_year)
+
+        return criteria
+
+    def _quote(self, text):
+        """Return text as an IMAP quoted string."""
+        return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def _search_new(self, imap, ledger=None):
+        """Return the UIDs of new messages, as bytes.
+
+        Keyword arguments:
+        imap -- logged in IMAP connection to search.
+        ledger -- optional Ledger recording the messages already seen.
+
+        """
+        last = ledger.last_uid(self.uidvalidity) if ledger is not None else None
+
+        criteria = self._criteria()
+
+        # with nothing recorded for this mailbox, start from whatever's unread.
+        if last is None:
+            status, data = imap.uid('SEARCH', '(UNSEEN{})'.format(criteria))
+        else:
+            status, data = imap.uid('SEARCH', '(UID {}:*{})'.format(last + 1, criteria))
+
+        logging.debug('Status from SEARCH: {}'.format(status))
+        logging.debug('Data from SEARCH: {}'.format(data))
+
+        if status != 'OK':
+            return []
+
+        uids = data[0].split() if data[0] else []
+
+        if last is not None:
+            # N:* always includes the newest message, even when its UID is below N.
+            uids = [uid for uid in uids if int(uid) > last]
+            uids = [str(uid).encode() for uid in ledger.pending(self.uidvalidity)] + uids
+
+        return uids
+
+    def _new_email(self, raw, uid, ledger=None, state=None, save_files=True):
+        """Return an Email parsed from raw, recording it in ledger as state.
+
+        Returns None if the message can't be parsed, recording it as skipped
+        so it isn't fetched again every time.
+
+        Keyword arguments:
+        raw -- bytes of the message as fetched from IMAP.
+        uid -- IMAP UID of the message.
+        ledger -- optional Ledger to record the message in.
+        state -- Ledger state to record, or None to not record it yet.
+        save_files -- whether to save attachments to temporary files.
+
+        """
+        try:
+            e = self._parse_message(raw, save_files=save_files)
+        except Exception:
+            logging.exception('Could not parse message {}, skipping it'.format(uid))
+
+            if ledger is not None:
+                ledger.skip(self.uidvalidity, uid)
 
-        if self.error:
             return None
 
-        emails = []
+        e.uid = uid
+        e.uidvalidity = self.uidvalidity
 
-        imap = self.imap
-        status, data = imap.search(None, '(UNSEEN)')
+        if ledger is not None and state is not None:
+            ledger.record(self.uidvalidity, uid, state)
 
-        logging.debug('Status from UNSEEN: {}'.format(status))
-        logging.debug('Data from UNSEEN: {}'.format(data))
+        return e
 
-        if status == 'OK' and len(data[0]) > 0:
-            logging.debug('There are new emails!')
-            split_data = str(data[0], encoding='utf8').split(' ')
-            logging.debug('Split data from UNSEEN: {}'.format(split_data))
+    def _fetch_new(self, imap, wanted=None, ledger=None):
+        """Return a list of Email objects for every new message wanted accepts.
 
-            for datum in split_data:
-                status, msg_info = self.imap.fetch(datum, 'RFC822')
+        Keyword arguments:
+        imap -- logged in IMAP connection to fetch from.
+        wanted -- optional function taking a preview Email, returning True if the message should be acted on.
+        ledger -- optional Ledger to find and record new messages with.
 
-                if status == 'OK':
-                    msg = HeaderParser().parsestr(str(msg_info[0][1], encoding='utf8'))
+        """
+        emails = []
+        uids = self._search_new(imap, ledger)
 
-                    sender = msg['From']
-                    receiver = msg['To']
-                    subject = msg['Subject']
+        if not uids:
+            return emails
 
-                    body = email.message_from_string(str(msg_info[0][1], encoding='utf8'))
+        logging.debug('There are {} new emails!'.format(len(uids)))
 
-                    text = ''
+        if ledger is not None:
+            # recorded before downloading, so any a FETCH fails on are pending next time rather than left behind.
+            for uid in uids:
+                ledger.record(self.uidvalidity, int(uid), Ledger.FETCHED)
+
+        if wanted is None or not self.preview_size:
+            for uid, meta, parts in self._fetch(imap, uids, '(RFC822)'):
+                e = self._new_email(parts[b'RFC822'], uid, ledger, Ledger.FETCHED)
+
+                if e is not None:
+                    emails.append(e)
 
-                    e = Email(sender=sender, receiver=receiver, subject=subject)
+            emails.sort(key=lambda e: e.uid)
+            return emails
 
-                    for part in body.walk():
-                        if part.get_content_maintype() == 'multipart':
-                            continue
+        query = '(RFC822.SIZE BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.{}>)'.format(self.preview_size)
+        truncated = []
+        seen = []
 
-                        if part.get_content_subtype() != 'plain':
-                            continue
+        for uid, meta, parts in self._fetch(imap, uids, query):
+            raw = parts.get(b'BODY[HEADER]', b'') + parts.get(b'BODY[TEXT]', b'')
+            e = self._new_email(raw, uid, ledger, save_files=False)
 
-                        if part.get('Content-Disposition') is None:
-                            e.body = part.get_payload()
-                            continue
+            if e is None:
+                seen.append(uid)
+                continue
 
-                        # if we end up down here, it's a file attachment
+            if not wanted(e):
+                logging.debug('Skipping message {}, nothing matches it'.format(uid))
+                seen.append(uid)
 
-                        filename = part.get_filename()
-                        filepath = tempfile.mkstemp()[1]
+                if ledger is not None:
+                    ledger.skip(self.uidvalidity, uid)
 
-                        with open(filepath, 'wb') as f:
-                            f.write(part.get_payload(decode=True))
+                continue
 
-                        e.attach_file(filename, filepath)
+            result = re.search(rb'RFC822\.SIZE (\d+)', meta)
 
+            if result and int(result.group(1)) > len(raw):
+                truncated.append(str(uid).encode())
+            else:
+                # the preview is the whole message, so parse it again, this time saving its attachments.
+                seen.append(uid)
+                e = self._new_email(raw, uid, ledger, Ledger.FETCHED)
+
+                if e is not None:
                     emails.append(e)
 
+        # previews are fetched with PEEK, so mark them read now they've been dealt with.
+        if seen:
+            imap.uid('STORE', ','.join(str(uid) for uid in seen), '+FLAGS', '(\\Seen)')
+
+        logging.debug('Downloading {} messages in full'.format(len(truncated)))
+
+        for uid, meta, parts in self._fetch(imap, truncated, '(RFC822)'):
+            e = self._new_email(parts[b'RFC822'], uid, ledger, Ledger.FETCHED)
+
+            if e is not None:
+                emails.append(e)
+
+        # messages that fit in their preview were added before the truncated ones, so put them back in the order
+        # they arrived, which is the order each sender's commands are run in.
+        emails.sort(key=lambda e: e.uid)
         return emails
 
-    def send_email(self, email):
-        """Send an email.
+    def _parse_message(self, raw, save_files=True):
+        """Return an Email built from the raw RFC822 bytes of a message.
 
         Keyword arguments:
-        email -- Email object to send
+        raw -- bytes of the message as fetched from IMAP.
+        save_files -- whether to save attachments to temporary files.
 
         """
-        logging.info('Sending message to {}'.format(email.receiver))
+        msg = email.message_from_bytes(raw, policy=email.policy.default)
 
-        to = [email.receiver] if not isinstance(email.receiver, list) else email.receiver
+        sender = str(msg.get('From', ''))
+        receiver = str(msg.get('To', ''))
+        subject = str(msg.get('Subject', ''))
+
+        e = Email(sender=sender, receiver=receiver, subject=subject, body='')
+        e.authentication_results = [str(h) for h in msg.get_all('Authentication-Results', [])]
+
+        try:
+            self._read_parts(e, msg, save_files)
+        except Exception:
+            e.cleanup()
+            raise
+
+        return e
+
+    def _read_parts(self, e, msg, save_files):
+        """Set the body of e from msg's first text/plain part, and attach its other parts.
+
+        Keyword arguments:
+        e -- Email object to fill in.
+        msg -- EmailMessage it was parsed from.
+        save_files -- whether to save attachments to temporary files.
+
+        """
+        parts = [msg]
+
+        while parts:
+            part = parts.pop(0)
+
+            # unlike walk(), this doesn't go inside attached messages, which are saved whole.
+            if part.get_content_maintype() == 'multipart':
+                parts[:0] = part.get_payload()
+                continue
+
+            if part.get_content_disposition() != 'attachment' and not part.get_filename():
+                if part.get_content_type() == 'text/plain' and not e.body:
+                    e.body = self._decode_text(part)
+
+                continue
+
+            # if we end up down here, it's a file attachment
+
+            if not save_files:
+                continue
+
+            if e.spool is None:
+                e.spool = tempfile.mkdtemp(prefix='makeme-', dir=self.spool_dir)
+
+            filename = os.path.basename(part.get_filename() or 'attachment')
+            filepath = os.path.join(e.spool, '{}-{}'.format(len(e.files), filename))
+
+            with open(filepath, 'wb') as f:
+                self._write_payload(part, f)
 
+            e.attach_file(filename, filepath)
+
+    def _write_payload(self, part, f):
+        """Write the decoded payload of part to f, decoding base64 a chunk at a time.
+
+        Keyword arguments:
+        part -- EmailMessage part to decode.
+        f -- binary file to write to.
+
+        """
+        if part.is_multipart():
+            # a forwarded message/rfc822, which has no payload of its own, so it's saved as the whole message.
+            f.write(part.get_payload(0).as_bytes())
+            return
+
+        if part.get('Content-Transfer-Encoding', '').lower() != 'base64':
+            f.write(part.get_payload(decode=True) or b'')
+            return
+
+        encoded = part.get_payload()
+        leftover = ''
+
+        for i in range(0, len(encoded), self.DECODE_CHUNK_SIZE):
+            chunk = leftover + ''.join(encoded[i:i + self.DECODE_CHUNK_SIZE].split())
+            end = len(chunk) - len(chunk) % 4
+            f.write(binascii.a2b_base64(chunk[:end]))
+            leftover = chunk[end:]
+
+        if leftover.strip('='):
+            # badly padded, which mail clients are forgiving of.
+            f.write(binascii.a2b_base64(leftover + '=' * (-len(leftover) % 4)))
+
+    def _decode_text(self, part):
+        """Return the text of a text/* message part, undoing its transfer encoding and charset.
+
+        Keyword arguments:
+        part -- EmailMessage part to decode.
+
+        """
+        try:
+            return part.get_content()
+        except LookupError:
+            # an unknown charset, so do the best we can.
+            return part.get_payload(decode=True).decode('utf8', errors='replace')
+
+    def _message_chunks(self, email, to):
+        """Generate the text of email a piece at a time, ending each piece on a line break.
+
+        Attachments are read and base64 encoded ATTACHMENT_CHUNK_SIZE bytes at a time, so the whole message never
+        needs to be held in memory.
+
+        Keyword arguments:
+        email -- Email object to render.
+        to -- list of addresses to put in the To header.
+
+        """
         msg = MIMEMultipart()
         msg['From'] = email.sender
-        msg['To'] = ', '.join(email.receiver)
+        msg['To'] = ', '.join(to)
         msg['Date'] = formatdate(localtime=True)
         msg['Subject'] = email.subject
 
         msg.attach(MIMEText(email.body))
 
-        if len(email.files) > 0:
-            for name, path in email.files:
-                data = open(name, 'rb').read()
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(data)
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', 'attachment; filename="{}"'.format(os.path.basename(name)))
+        text = msg.as_string()
+        closing = '--{}--\n'.format(msg.get_boundary())
+
+        if not email.files:
+            yield text
+            return
+
+        # leave the multipart open so the attachments can be written after the body
+        yield text[:text.rindex(closing)]
+
+        for name, path in email.files:
+            part = MIMEBase('application', 'octet-stream')
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(name))
+
+            yield '--{}\n'.format(msg.get_boundary())
+            yield part.as_string()
+
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(self.ATTACHMENT_CHUNK_SIZE), b''):
+                    yield base64.encodebytes(data).decode('ascii')
+
+            yield '\n'
+
+        yield closing
+
+    def _sendmail(self, smtp, to, chunks):
+        """Send a message to SMTP as it's generated, rather than building it in memory first.
+
+        Does the same as smtplib.SMTP.sendmail, raising the same exceptions, but writes the DATA a chunk at a time.
+
+        Keyword arguments:
+        smtp -- connected smtplib.SMTP object.
+        to -- list of addresses to send to.
+        chunks -- iterable of strings making up the message, each ending on a line break.
+
+        """
+        code, response = smtp.mail(self.username)
+
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, response, self.username)
+
+        refused = {}
+
+        for address in to:
+            code, response = smtp.rcpt(address)
+
+            if code not in (250, 251):
+                refused[address] = (code, response)
+
+        if len(refused) == len(to):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        smtp.putcmd('data')
+        code, response = smtp.getreply()
+
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+        for chunk in chunks:
+            smtp.send(smtplib.quotedata(chunk))
+
+        smtp.send('.\r\n')
+        code, response = smtp.getreply()
+
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+        if refused:
+            logging.warning('Some recipients were refused: {}'.format(refused))
+
+    def send_email(self, email):
+        """Send an email. Return True if it was sent, False if SMTP couldn't be reached.
+
+        Keyword arguments:
+        email -- Email object to send
+
+        """
+        logging.info('Sending message to {}'.format(email.receiver))
+
+        to = [email.receiver] if not isinstance(email.receiver, list) else email.receiver
 
-                msg.attach(part)
+        with self.smtp_lock:
+            smtp = self.smtp_connection()
+
+            if smtp is None:
+                logging.error('Could not send message to {}, SMTP is unavailable'.format(email.receiver))
+                return False
+
+            try:
+                self._sendmail(smtp, to, self._message_chunks(email, to))
+            except smtplib.SMTPServerDisconnected as e:
+                logging.error('SMTP connection lost while sending message: {}'.format(e))
+                self.smtp = None
+                return False
+            except smtplib.SMTPException:
+                # the server refused this message, but the connection is still good. SMTPException is an OSError.
+                raise
+            except OSError as e:
+                logging.error('SMTP connection lost while sending message: {}'.format(e))
+                self.smtp = None
+                return False
 
-        self.smtp.sendmail(self.username, to, msg.as_string())
         logging.debug('Message sent')
+        return True
 
@@ -0,0 +1,156 @@
+'''
+File: engine.py
+Author: Nathan Hoad
+Description: Runs makeme on a single asyncio event loop
+'''
+
+import asyncio
+import logging
+import signal
+
+from email.utils import parseaddr
+
+
+class AsyncEngine(object):
+    def __init__(self, server):
+        """Initialise the AsyncEngine for server.
+
+        IMAP and SMTP are driven from the loop's default executor, since
+        imaplib and smtplib block, while scripts run as asyncio subprocesses.
+        Each command costs a coroutine rather than an OS thread.
+
+        Keyword arguments:
+        server -- MakeMe object whose config, connections and ledger are used.
+
+        """
+        self.server = server
+        self._tasks = set()
+        # a lock per sender so their messages run in order, and how many messages are using it.
+        self._senders = {}
+        self._stopped = None
+        self._workers = None
+
+    async def _act(self, account, message):
+        """Run the script matching message and reply with its output.
+
+        Keyword arguments:
+        account -- Account the message was sent to.
+        message -- Email object to handle.
+
+        """
+        server = self.server
+        command = server._prepare(account, message)
+
+        if command is None:
+            return
+
+        script, timeout, warm, reply = command
+
+        try:
+            returncode, reply_script, reply_message = await server.runner.run_async(script, server._script_args(message), timeout, warm, reply.feed)
+        except Exception as e:
+            server._finish(message, reply, script, error=e)
+        else:
+            server._finish(message, reply, script, reply_message)
+
+    async def _check_messages(self):
+        """Fetch new messages from every account at once and start a task to handle each one."""
+        server = self.server
+        loop = asyncio.get_running_loop()
+
+        logging.info('Checking messages...')
+
+        fetches = [loop.run_in_executor(None, account.mail_handler.get_messages, account.wanted, account.ledger) for account in server.accounts]
+        found = await asyncio.gather(*fetches, return_exceptions=True)
+
+        # a failed fetch only loses that account's check this time, as it does with threads.
+        for i, (account, messages) in enumerate(zip(server.accounts, found)):
+            if isinstance(messages, Exception):
+                logging.error('Checking {} failed'.format(account), exc_info=messages)
+                found[i] = []
+
+        server.schedule.observe(sum(len(messages) for messages in found))
+
+        for account, messages in zip(server.accounts, found):
+            for m in messages:
+                if not account.ledger.queue(m.uidvalidity, m.uid):
+                    logging.info('Message {} is already queued, skipping'.format(m.uid))
+                    m.cleanup()
+                    continue
+
+                task = loop.create_task(self._handle(account, m))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, account, message):
+        """Handle message once every earlier message from the same sender has been handled.
+
+        Keyword arguments:
+        account -- Account the message was sent to.
+        message -- Email object to handle.
+
+        """
+        sender = parseaddr(message.sender)[1].lower()
+        lock, users = self._senders.get(sender, (None, 0))
+        lock = lock or asyncio.Lock()
+        self._senders[sender] = (lock, users + 1)
+
+        try:
+            async with lock, self._workers:
+                await self._act(account, message)
+        except Exception:
+            logging.exception('Handling message {} failed'.format(message.uid))
+        finally:
+            # the last message from a sender removes its lock, so every sender ever seen isn't kept forever.
+            lock, users = self._senders[sender]
+
+            if users == 1:
+                del self._senders[sender]
+            else:
+                self._senders[sender] = (lock, users - 1)
+
+    async def _main(self):
+        """Check for messages until the server is stopped, then wait for running commands to finish."""
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._workers = asyncio.Semaphore(self.server.settings.max_workers)
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        try:
+            while self.server.running():
+                await self._check_messages()
+                await self._wait()
+        finally:
+            if self._tasks:
+                logging.info('Waiting for {} commands to finish'.format(len(self._tasks)))
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+
+    async def _wait(self):
+        """Wait until the message queue should be checked, or the server is stopped."""
+        server = self.server
+        loop = asyncio.get_running_loop()
+
+        # IDLE wakes up every second to check server.running(), so it stops promptly too.
+        if await loop.run_in_executor(None, server._idle):
+            return
+
+        try:
+            await asyncio.wait_for(self._stopped.wait(), server.schedule.delay())
+        except asyncio.TimeoutError:
+            pass
+
+    def run(self):
+        """Run the engine until the server is stopped."""
+        asyncio.run(self._main())
+
+    def stop(self):
+        """Stop the server and wake the engine if it's waiting."""
+        self.server.stop()
+
+        if self._stopped is not None:
+            self._stopped.set()
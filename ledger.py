@@ -0,0 +1,185 @@
+'''
+File: ledger.py
+Author: Nathan Hoad
+Description: Keeps track of which messages have already been processed
+'''
+
+import sqlite3
+import threading
+import time
+
+
+class Ledger(object):
+    # a message moves through these states in order, except skipped ones which never match a pattern.
+    FETCHED = 'fetched'
+    SKIPPED = 'skipped'
+    EXECUTED = 'executed'
+    REPLIED = 'replied'
+
+    def __init__(self, path, source=''):
+        """Initialise the Ledger, creating the sqlite database at path if needed.
+
+        Messages are keyed by UIDVALIDITY and UID, so a mailbox that's been
+        recreated on the server is treated as brand new rather than having its
+        UIDs mistaken for old ones.
+
+        Keyword arguments:
+        path -- sqlite database to record messages in.
+        source -- name of the account and mailbox the messages come from, so several can share one database.
+
+        """
+        self.path = path
+        self.source = source
+        self._lock = threading.Lock()
+        # messages waiting for a worker in this process. Not saved, so after a crash they're pending again.
+        self._queued = set()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(messages)')]
+
+        if columns and 'source' not in columns:
+            self._migrate()
+
+        self._db.execute('''CREATE TABLE IF NOT EXISTS messages (
+            source TEXT NOT NULL DEFAULT '',
+            uidvalidity INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (source, uidvalidity, uid))''')
+
+    def _migrate(self):
+        """Add the source column to a database from before there could be more than one mailbox."""
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('ALTER TABLE messages RENAME TO old_messages')
+            self._db.execute('''CREATE TABLE messages (
+                source TEXT NOT NULL DEFAULT '',
+                uidvalidity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (source, uidvalidity, uid))''')
+            self._db.execute('INSERT INTO messages (uidvalidity, uid, state, updated) SELECT uidvalidity, uid, state, updated FROM old_messages')
+            self._db.execute('DROP TABLE old_messages')
+
+    def _execute(self, sql, *args):
+        """Run sql with args under the lock and return the cursor."""
+        with self._lock:
+            return self._db.execute(sql, args)
+
+    def claim(self, uidvalidity, uid):
+        """Mark a fetched message as executed. Return False if it already was, meaning it must be skipped.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox the message is in.
+        uid -- IMAP UID of the message. Messages without one can't be tracked and are always claimed.
+
+        """
+        if uid is None:
+            return True
+
+        self.record(uidvalidity, uid, self.FETCHED)
+
+        with self._lock:
+            self._queued.discard((uidvalidity, uid))
+
+        cursor = self._execute('UPDATE messages SET state = ?, updated = ? WHERE source = ? AND uidvalidity = ? AND uid = ? AND state = ?',
+                self.EXECUTED, time.time(), self.source, uidvalidity, uid, self.FETCHED)
+
+        return cursor.rowcount == 1
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def last_uid(self, uidvalidity):
+        """Return the highest UID recorded for uidvalidity, or None if there are none.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox.
+
+        """
+        return self._execute('SELECT MAX(uid) FROM messages WHERE source = ? AND uidvalidity = ?', self.source, uidvalidity).fetchone()[0]
+
+    def pending(self, uidvalidity):
+        """Return the UIDs that were fetched but never executed, e.g. because of a crash.
+
+        Messages that are queued in this process are left out, since
+        they'll be executed once a worker gets to them.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox.
+
+        """
+        rows = self._execute('SELECT uid FROM messages WHERE source = ? AND uidvalidity = ? AND state = ? ORDER BY uid', self.source, uidvalidity, self.FETCHED)
+
+        with self._lock:
+            return [uid for uid, in rows if (uidvalidity, uid) not in self._queued]
+
+    def queue(self, uidvalidity, uid):
+        """Note that a fetched message is waiting for a worker. Return False if it already is, meaning it must be skipped.
+
+        The message stays fetched until claim() is called as its script
+        starts, so it isn't lost if makeme stops before then.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox the message is in.
+        uid -- IMAP UID of the message. Messages without one can't be tracked and are always queued.
+
+        """
+        if uid is None:
+            return True
+
+        with self._lock:
+            if (uidvalidity, uid) in self._queued:
+                return False
+
+            self._queued.add((uidvalidity, uid))
+            return True
+
+    def record(self, uidvalidity, uid, state):
+        """Record a message as being in state, unless it's already recorded.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox the message is in.
+        uid -- IMAP UID of the message.
+        state -- one of FETCHED or SKIPPED.
+
+        """
+        if uid is None:
+            return
+
+        self._execute('INSERT OR IGNORE INTO messages (source, uidvalidity, uid, state, updated) VALUES (?, ?, ?, ?, ?)',
+                self.source, uidvalidity, uid, state, time.time())
+
+    def skip(self, uidvalidity, uid):
+        """Mark a message as skipped, whether or not it was recorded as fetched first.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox the message is in.
+        uid -- IMAP UID of the message.
+
+        """
+        if uid is None:
+            return
+
+        self.record(uidvalidity, uid, self.SKIPPED)
+        self._execute('UPDATE messages SET state = ?, updated = ? WHERE source = ? AND uidvalidity = ? AND uid = ? AND state = ?',
+                self.SKIPPED, time.time(), self.source, uidvalidity, uid, self.FETCHED)
+
+    def replied(self, uidvalidity, uid):
+        """Mark an executed message as replied to.
+
+        Keyword arguments:
+        uidvalidity -- UIDVALIDITY of the mailbox the message is in.
+        uid -- IMAP UID of the message.
+
+        """
+        if uid is None:
+            return
+
+        self._execute('UPDATE messages SET state = ?, updated = ? WHERE source = ? AND uidvalidity = ? AND uid = ?',
+                self.REPLIED, time.time(), self.source, uidvalidity, uid)
@@ -2,25 +2,47 @@
 import os
 import logging
 import configparser
+import functools
+import hashlib
+import re
+import signal
 import sys
-import time
+import threading
 import imaplib
 import smtplib
 import socket
-import subprocess
 
-from threads import MessageProcessor
-from emails import Email, MailHandler
+from account import Account
+from dispatch import Dispatcher
+from engine import AsyncEngine
+from monitor import ConfigMonitor
+from reply import Reply
+from runner import ScriptRunner, ScriptTimeout
+from schedule import Schedule
+from settings import Settings, SettingsError
+from threads import MessageProcessor, WorkerPool
 
 
 class MakeMe(object):
+    # settings that are only read at startup.
+    RESTART_SETTINGS = ('fork', 'log_file', 'log_format', 'log_level', 'date_format', 'ledger_file', 'engine',
+            'max_workers', 'max_reply_size', 'warm_modules', 'reply_batch_size', 'reply_retry_delay',
+            'reply_retry_max', 'reply_attempts', 'reply_coalesce', 'monitor_config')
+
     def __init__(self):
         """Initialise the MakeMe object. Sets _running to True, loads the config and logging, forking if requested."""
         self._running = True
+        self._stopped = threading.Event()
+        self._idle_handler = None
+        self._idle_supported = True
+        self._monitor = None
+        self._idle_stale = False
+        self._recheck = False
         self._load_config()
-        self._load_patterns()
+        self._load_accounts()
+        self.schedule = self._read_schedule(self.settings)
 
-        if self.config.getboolean('settings', 'fork'):
+        if self.settings.fork:
             pid = os.fork()
 
             if pid:
@@ -29,102 +51,320 @@ class MakeMe(object):
         self._start_logging()
         logging.info('Starting Makeme server')
 
-        if not self.config.getboolean('settings', 'sent_welcome_message'):
+        directory = os.path.dirname(os.path.realpath(__file__))
+        self.runner = ScriptRunner(os.path.join(directory, 'scripts'), self.settings.max_reply_size)
+
+        # the zygote is forked, so it has to start while this is the only thread.
+        if any(warm for name, mailbox, settings, patterns in self._account_settings for p, script, timeout, warm in patterns):
+            self.runner.start_warm(self.settings.warm_modules)
+
+        self.pool = WorkerPool(self.settings.max_workers)
+        self.accounts = [Account(*account) for account in self._account_settings]
+
+        if not self.settings.sent_welcome_message:
             self._send_welcome_message()
-            self.config.set('settings', 'sent_welcome_message', True)
+            self.config.set('settings', 'sent_welcome_message', 'yes')
+            self.settings = self.settings._replace(sent_welcome_message=True)
 
             with open(self.local_config, 'w') as f:
                 self.config.write(f)
 
-    def _act(self, mail_handler, message):
+        # after the welcome message, so writing sent_welcome_message doesn't set off a reload.
+        if self.settings.monitor_config:
+            self._monitor = ConfigMonitor(self.config_file, self.reload_config)
+
+    def _act(self, account, mail_handler, message):
         """Interpret and handle a message.
 
         Keyword arguments:
+        account -- Account the message was sent to.
         mail_handler -- MailHandler object. Intended only to send emails
         message -- Email object to parse and handle.
 
         """
-        patterns = self.patterns
+        command = self._prepare(account, message)
 
-        for p, script in patterns:
-            if message.match(p):
-                logging.info('executing {}'.format(script))
+        if command is None:
+            return
 
-                directory = os.path.dirname(os.path.realpath(__file__))
+        script, timeout, warm, reply = command
 
-                command = os.path.join(directory, 'scripts/{}'.format(script))
+        try:
+            returncode, reply_script, reply_message = self.runner.run(script, self._script_args(message), timeout, warm, reply.feed)
+        except Exception as e:
+            self._finish(message, reply, script, error=e)
+        else:
+            self._finish(message, reply, script, reply_message)
 
-                args = [' '.join(message.receiver)]
-                args.append(message.subject)
-                args.append(message.body)
-                args.append(message.sender)
+    def _finish(self, message, reply, script, output=None, error=None):
+        """Send the reply to a command once its script has run, and delete the message's attachments.
 
-                pipe = subprocess.Popen(args, executable=command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                pipe.wait()
+        Keyword arguments:
+        message -- Email object the script was run for.
+        reply -- Reply the script's stdout was fed to.
+        script -- name of the script.
+        output -- what the script wrote to stderr, which is the reply's text.
+        error -- the exception raised if the script timed out or couldn't be run, instead of output.
 
-                logging.info('Popen for {} is complete'.format(command))
+        """
+        try:
+            if isinstance(error, ScriptTimeout):
+                output = self._timed_out_message(error)
+            elif error is not None:
+                logging.error('Could not run {}'.format(script), exc_info=error)
+                output = self._failed_message(script, error)
 
-                reply_message = str(pipe.stderr.read(), encoding='utf8')
-                reply_script = str(pipe.stdout.read(), encoding='utf8')
+            reply.send(output)
+        finally:
+            message.cleanup()
 
-                if reply_script:
-                    print('process script')
-                else:
-                    subject = 'RE: {}'.format(message.subject)
-                    sender = message.sender
-                    body = reply_message
-                    mail_handler.send_email(Email(receiver=sender, subject=subject, body=body, sender=self.config.get('settings', 'username')))
-
-                break
-
-        logging.info('_act() not yet implemented')
-
-    def _get_mailhandler(self):
-        """Return a MailHandler object built from the config."""
-        get = self.config.get
-        getint = self.config.getint
-        getboolean = self.config.getboolean
-        username = get('settings', 'username')
-        password = get('settings', 'password')
-        smtp_server = get('settings', 'smtp_server')
-        smtp_port = getint('settings', 'smtp_port')
-        imap_server = get('settings', 'imap_server')
-        imap_port = getint('settings', 'imap_port')
-        use_tls = getboolean('settings', 'smtp_tls')
-        use_ssl = getboolean('settings', 'imap_ssl')
-
-        return MailHandler(username, password, smtp_server, smtp_port, imap_server, imap_port, use_ssl, use_tls)
+    def _prepare(self, account, message):
+        """Return (script, timeout, warm, reply) for the command in message, or None if no script should be run for it.
+
+        Both engines call this before running a script, then _finish()
+        after. If None is returned, the message has already been cleaned up.
+
+        Keyword arguments:
+        account -- Account the message was sent to.
+        message -- Email object to handle.
+
+        """
+        # claimed only now the message has reached a worker, so one still queued is pending again after a crash.
+        if not account.ledger.claim(message.uidvalidity, message.uid):
+            logging.info('Message {} has already been processed, skipping'.format(message.uid))
+            message.cleanup()
+            return None
+
+        # checked before matching, so mail that isn't allowed never starts a script.
+        if not account.authorised(message):
+            message.cleanup()
+            return None
+
+        rule = account.dispatcher.match(message)
+
+        if rule is None:
+            logging.info('Nothing matches message from {}'.format(message.sender))
+            message.cleanup()
+            return None
+
+        p, script, timeout, warm = rule
+        logging.info('{} matched {}, executing {}'.format(message.sender, p, script))
+
+        return script, timeout, warm, self._new_reply(account, message)
+
+    def _new_reply(self, account, message):
+        """Return a Reply to message, for its script's stdout to be fed to as it runs.
+
+        Keyword arguments:
+        account -- Account the message was sent to, which the reply is sent from.
+        message -- Email object the script is being run for.
+
+        """
+        return Reply(message, account.settings.username, account.outbox)
+
+    def _script_args(self, message):
+        """Return the argument list to run a script for message with.
+
+        Keyword arguments:
+        message -- Email object the script is being run for.
+
+        """
+        args = [' '.join(message.receiver)]
+        args.append(message.subject)
+        args.append(message.body)
+        args.append(message.sender)
+
+        if message.files:
+            # (name, path) pairs for each attachment, as save_files.py expects.
+            args.append(repr(message.files))
+
+        return args
+
+    def _failed_message(self, script, error):
+        """Return the reply for a script that couldn't be run, e.g. because it's missing or not executable.
+
+        Keyword arguments:
+        script -- name of the script.
+        error -- the exception that was raised.
+
+        """
+        return 'Your command could not be run, {} failed: {}'.format(script, error)
+
+    def _timed_out_message(self, error):
+        """Return the reply for a script that was killed for running too long.
+
+        Keyword arguments:
+        error -- the ScriptTimeout that was raised.
+
+        """
+        return 'Your command timed out after {} seconds and was stopped.\n\n{}'.format(error.timeout, error.stderr)
 
     def _load_config(self):
         """Load global (/usr/share/makeme/makeme.conf) and user-level ($HOME/.makeme/makeme.conf) config files."""
-        config = dict()
+        found = self._find_config()
 
-        global_config = '/usr/share/makeme/makeme.conf'
-        local_config =self.local_config = os.path.join(os.environ['HOME'], '.makeme/makeme.conf')
-
-        config['log_file'] = os.path.join(os.environ['HOME'], '.makeme/makeme.log')
-        config['log_format'] = '[%(asctime)s] %(levelname)s: %(message)s'
-        config['log_level'] = 'INFO'
-        config['date_format'] = '%Y-%m-%d %H:%M:%S'
-        config['smtp_server'] = 'smtp.gmail.com'
-        config['smtp_port'] = 587
-        config['smtp_tls'] = 'yes'
-        config['imap_server'] = 'imap.gmail.com'
-        config['imap_port'] = 993
-        config['imap_ssl'] = 'yes'
-        config['sent_welcome_message'] = 'no'
-        config['fork'] = False
-        config['refresh_time'] = 5
-
-        self.config = configparser.RawConfigParser(config)
-
-        if not self.config.read(global_config) and not self.config.read(local_config):
+        if found is None:
             print('No makeme.conf file could be found. Check the documentation for details.', file=sys.stderr)
             sys.exit(1)
 
-    def _load_patterns(self):
-        """Load patterns from _config."""
-        self.patterns = self.config.items('scripts')
+        self.config_file, data = found
+        self.config, self.settings = self._parse_config(self.config_file, data)
+        self._config_digest = hashlib.sha256(data).hexdigest()
+
+    def _find_config(self):
+        """Return the name and contents of the config file, or None if there isn't one."""
+        global_config = '/usr/share/makeme/makeme.conf'
+        local_config = self.local_config = os.path.join(os.environ['HOME'], '.makeme/makeme.conf')
+
+        for filename in (global_config, local_config):
+            try:
+                with open(filename, 'rb') as f:
+                    return filename, f.read()
+            except OSError:
+                continue
+
+        return None
+
+    def _parse_config(self, filename, data):
+        """Return a RawConfigParser of the config file, and the Settings from it.
+
+        Raises SettingsError if any settings are missing or invalid.
+
+        Keyword arguments:
+        filename -- name of the config file, for error messages.
+        data -- contents of the config file.
+
+        """
+        config = configparser.RawConfigParser()
+        config.read_string(str(data, encoding='utf8'), filename)
+
+        return config, Settings.from_config(config)
+
+    def _idle(self):
+        """Wait for new mail using IMAP IDLE. Return False if IDLE can't be used and polling should be done instead."""
+        if not self._idle_supported or not self.settings.idle:
+            return False
+
+        # one IDLE can only watch one mailbox, so several are polled instead.
+        if len(self.accounts) > 1:
+            return False
+
+        if self._idle_stale and self._idle_handler is not None:
+            self._idle_handler.close()
+            self._idle_handler = None
+
+        self._idle_stale = False
+
+        if self._idle_handler is None:
+            # IDLE ties up its connection, so it can't share the account's mail_handler.
+            self._idle_handler = self.accounts[0].new_mailhandler()
+
+            if not self._idle_handler.supports_idle():
+                if not self._idle_handler.error:
+                    logging.info('IMAP server does not support IDLE, falling back to polling')
+                    self._idle_supported = False
+
+                self._idle_handler.close()
+                self._idle_handler = None
+                return False
+
+        try:
+            # stop idling early if the login details are changed, so it reconnects with the new ones.
+            self._idle_handler.idle(running=lambda: self._running and not self._idle_stale)
+        except (imaplib.IMAP4.error, OSError) as e:
+            logging.error('IMAP IDLE failed, polling this cycle instead: {}'.format(e))
+            # drop the dead connection, it'll be reopened on the next wait.
+            self._idle_handler.imap = None
+            return False
+
+        return True
+
+    def _load_accounts(self):
+        """Load the accounts and patterns from config and check them, before any connections are made."""
+        self._account_settings = self._read_accounts(self.config, self.settings)
+
+        for name, mailbox, settings, patterns in self._account_settings:
+            Dispatcher(patterns)
+
+    def _read_accounts(self, config, settings):
+        """Return a (name, mailbox, settings, patterns) tuple for each mailbox of each account in config.
+
+        The account in [settings] has the name ''. Each [account NAME]
+        section adds another, using the rules in [scripts NAME] if there is
+        one, or [scripts] if not.
+
+        Keyword arguments:
+        config -- RawConfigParser to read the accounts from.
+        settings -- Settings from the same config.
+
+        """
+        patterns = self._read_patterns(config, settings)
+        accounts = [('', mailbox, settings, patterns) for mailbox in settings.mailboxes]
+
+        for section in config.sections():
+            kind, _, name = section.partition(' ')
+
+            if kind != 'account':
+                continue
+
+            name = name.strip()
+            account_settings = Settings.from_config(config, section, settings)
+            scripts = 'scripts ' + name
+            account_patterns = self._read_patterns(config, account_settings, scripts) if config.has_section(scripts) else patterns
+
+            accounts.extend((name, mailbox, account_settings, account_patterns) for mailbox in account_settings.mailboxes)
+
+        return accounts
+
+    def _read_patterns(self, config, settings, section='scripts'):
+        """Return the list of (pattern, script, timeout, warm) rules in a [scripts] section of config.
+
+        Each pattern maps to a script name, optionally followed by
+        timeout=N to override script_timeout for that script, and warm to
+        run it in a pre-forked interpreter.
+
+        Keyword arguments:
+        config -- RawConfigParser to read the rules from.
+        settings -- Settings from the same config.
+        section -- name of the section to read.
+
+        """
+        defaults = config.defaults()
+        default_timeout = settings.script_timeout
+
+        patterns = []
+
+        for p, value in config.items(section):
+            # items() mixes any [DEFAULT] values in with the real patterns.
+            if p in defaults:
+                continue
+
+            script, *options = value.split()
+            timeout = default_timeout
+            warm = False
+
+            for option in options:
+                name, _, number = option.partition('=')
+
+                if option == 'warm':
+                    warm = True
+                elif name == 'timeout' and number.isdigit():
+                    timeout = int(number)
+                else:
+                    raise ValueError('unknown option {!r} for {}'.format(option, p))
+
+            patterns.append((p, script, timeout, warm))
+
+        return patterns
+
+    def _read_schedule(self, settings):
+        """Return the Schedule for the refresh_time, poll_min and poll_max settings.
+
+        Keyword arguments:
+        settings -- Settings to read them from.
+
+        """
+        return Schedule(settings.refresh_time, settings.poll_min, settings.poll_max)
 
     def _send_welcome_message(self):
         """Send the welcome message to username from config."""
@@ -132,19 +372,78 @@ class MakeMe(object):
 
     def _start_logging(self):
         """Start logging to $HOME/.makeme/makeme.log."""
-        c = self.config
-        log_format = c.get('settings', 'log_format')
-        date_format = c.get('settings', 'date_format')
-        log_level = eval('logging.{}'.format(c.get('settings', 'log_level').upper()))
-        log_file = c.get('settings', 'log_file')
-        logging.basicConfig(filename=log_file, level=log_level, format=log_format, datefmt=date_format)
+        s = self.settings
+        logging.basicConfig(filename=s.log_file, level=s.level, format=s.log_format, datefmt=s.date_format)
 
     def check_messages(self):
         """Check for messages and call _act() on each one."""
-        logging.info('Checking messages...')
+        self._recheck = False
+
+        for account in self.accounts:
+            # a slow fetch mustn't have a second one started on top of it, but what woke this check mustn't be lost.
+            if account.processor is not None and account.processor.is_alive():
+                logging.info('Previous check of {} is still running, checking again once it finishes'.format(account))
+                self._recheck = True
+                continue
+
+            logging.info('Checking messages in {}...'.format(account))
+
+            # every account shares the pool, so max_workers covers all of them.
+            account.processor = MessageProcessor(account.mail_handler, functools.partial(self._act, account), account.wanted, self.pool, account.ledger)
+            account.processor.start()
 
-        MessageProcessor(self._get_mailhandler, self._act).start()
+    def reload_config(self):
+        """Reload the config file, swapping in the new patterns and settings without stopping.
 
+        Commands that are already running finish with the rules they started
+        with. Connections are only reopened if the login details changed. If
+        the new config has errors, it's ignored and the old one is kept.
+
+        """
+        found = self._find_config()
+
+        if found is None:
+            logging.error('Config file has gone, keeping the current config')
+            return
+
+        filename, data = found
+        digest = hashlib.sha256(data).hexdigest()
+
+        # editors and our own writes touch the file without changing it.
+        if digest == self._config_digest:
+            logging.debug('Config file is unchanged, not reloading')
+            return
+
+        try:
+            config, settings = self._parse_config(filename, data)
+            accounts = {(name, mailbox): (account_settings, patterns, Dispatcher(patterns))
+                    for name, mailbox, account_settings, patterns in self._read_accounts(config, settings)}
+            schedule = self._read_schedule(settings)
+        except (configparser.Error, re.error, ValueError) as e:
+            logging.error('Not reloading the config, it has an error: {}'.format(e))
+            return
+
+        for name in self.RESTART_SETTINGS:
+            if getattr(settings, name) != getattr(self.settings, name):
+                logging.warning('{} was changed, but only takes effect after a restart'.format(name))
+
+        if set(accounts) != set((account.name, account.mailbox) for account in self.accounts):
+            logging.warning('Accounts or mailboxes were added or removed, but that only takes effect after a restart')
+
+        for account in self.accounts:
+            if (account.name, account.mailbox) not in accounts:
+                continue
+
+            if account.update(*accounts[account.name, account.mailbox]) and account is self.accounts[0]:
+                self._idle_supported = True
+                self._idle_stale = True
+
+        self.config = config
+        self.settings = settings
+        self._config_digest = digest
+        self.schedule = schedule
+
+        logging.info('Reloaded the config for {} mailboxes'.format(len(self.accounts)))
 
     def running(self):
         """Return True if the server is running, false otherwise."""
@@ -154,14 +453,59 @@ class MakeMe(object):
         """Shutdown the server and all relevant connections."""
         logging.info('Shutting down Makeme')
 
+        if self._monitor is not None:
+            self._monitor.stop()
+
+        self.pool.shutdown()
+
+        for account in self.accounts:
+            account.close()
+
+        self.runner.close()
+
+        if self._idle_handler is not None:
+            self._idle_handler.close()
+
     def stop(self):
         """Stop the server."""
         logging.info('Stopping Makeme')
         self._running = False
+        self._stopped.set()
 
     def wait(self):
-        """Sleep until the message queue should be checked."""
-        time.sleep(self.config.getint('settings', 'refresh_time'))
+        """Wait until the message queue should be checked, using IMAP IDLE where the server supports it.
+
+        Otherwise waits until refresh_time is next due, returning early if the server is stopped.
+        If the last check skipped an account because its previous check was
+        still running, returns as soon as that finishes so it's checked again.
+
+        """
+        if self._recheck:
+            # IDLE would only report mail that arrives from now on, missing whatever the skipped check was for.
+            for account in self.accounts:
+                if account.processor is not None:
+                    account.processor.join()
+
+            return
+
+        if self._idle():
+            return
+
+        found = None
+
+        # adaptive polling needs to know whether the last check found anything, once per check.
+        for account in self.accounts:
+            processor = account.processor
+
+            if processor is not None and processor is not account.observed:
+                processor.fetched.wait()
+                found = (found or 0) + processor.found
+                account.observed = processor
+
+        if found is not None:
+            self.schedule.observe(found)
+
+        self.schedule.wait(self._stopped)
 
 
 class MakeMeCLI(MakeMe):
@@ -178,19 +522,35 @@ class MakeMeCLI(MakeMe):
 
 try:
     if __name__ == '__main__':
-        server = MakeMeCLI()
+        # only errors in the config are caught here, anything later is a bug rather than the user's mistake.
+        try:
+            server = MakeMeCLI()
+        except SettingsError as e:
+            print('Makeme: Error processing your makeme.conf:', e, file=sys.stderr)
+            sys.exit(1)
+        except (re.error, ValueError) as e:
+            print('Makeme: Error in the [scripts] section of your makeme.conf:', e, file=sys.stderr)
+            sys.exit(1)
+
         running = server.running
         wait = server.wait
         check_messages = server.check_messages
 
-        while running():
-            check_messages()
-            wait()
+        try:
+            if server.settings.engine == 'asyncio':
+                AsyncEngine(server).run()
+            else:
+                signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
 
-        server.shutdown()
+                while running():
+                    check_messages()
+                    wait()
+        finally:
+            server.shutdown()
 
 except KeyboardInterrupt:
-    server.shutdown()
+    # the server has already been shut down on the way out.
+    pass
 except (configparser.NoSectionError, configparser.NoOptionError) as e:
     print('Makeme: Error processing your makeme.conf:', e, file=sys.stderr)
     server.shutdown()
@@ -0,0 +1,99 @@
+'''
+File: monitor.py
+Author: Nathan Hoad
+Description: Watches the config file and calls back when it changes
+'''
+
+import logging
+import os
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+class ConfigMonitor(object):
+    # seconds between checks of the file's modification time, when inotify isn't available.
+    POLL_INTERVAL = 2
+
+    def __init__(self, filename, callback):
+        """Initialise the ConfigMonitor and start watching filename.
+
+        Uses inotify through pyinotify if it's installed, otherwise checks
+        the file's modification time every POLL_INTERVAL seconds. The
+        directory is watched rather than the file, so editors that save by
+        replacing the file are still noticed.
+
+        Keyword arguments:
+        filename -- config file to watch.
+        callback -- function called with no arguments after the file changes.
+
+        """
+        self.filename = os.path.realpath(filename)
+        self.callback = callback
+        self._stopped = threading.Event()
+        self._notifier = None
+
+        if pyinotify is not None:
+            self._start_inotify()
+        else:
+            logging.info('pyinotify is not installed, checking {} for changes every {} seconds'.format(self.filename, self.POLL_INTERVAL))
+            self._thread = threading.Thread(target=self._poll, name='ConfigMonitor', daemon=True)
+            self._thread.start()
+
+    def _changed(self):
+        """Call the callback, logging rather than raising anything it throws."""
+        logging.info('{} changed, reloading'.format(self.filename))
+
+        try:
+            self.callback()
+        except Exception:
+            logging.exception('Reloading {} failed'.format(self.filename))
+
+    def _mtime(self):
+        """Return the modification time and size of the file, or None if it doesn't exist right now."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def _poll(self):
+        """Check the file's modification time until stop() is called."""
+        last = self._mtime()
+
+        while not self._stopped.wait(self.POLL_INTERVAL):
+            current = self._mtime()
+
+            # None means it's midway through being replaced, so wait for the new one.
+            if current is not None and current != last:
+                last = current
+                self._changed()
+
+    def _start_inotify(self):
+        """Watch the file's directory with inotify."""
+        directory, name = os.path.split(self.filename)
+        monitor = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.name == name:
+                    monitor._changed()
+
+        manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+        manager.add_watch(directory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+
+    def stop(self):
+        """Stop watching the file."""
+        self._stopped.set()
+
+        if self._notifier is not None:
+            self._notifier.stop()
+        else:
+            self._thread.join()
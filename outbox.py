@@ -0,0 +1,270 @@
+'''
+File: outbox.py
+Author: Nathan Hoad
+Description: Queues replies on disk and sends them in the background, retrying failures
+'''
+
+import collections
+import json
+import logging
+import os
+import shutil
+import smtplib
+import sqlite3
+import threading
+import time
+
+from emails import Email
+
+
+class Outbox(object):
+    def __init__(self, path, mail_handler, ledger=None, batch_size=20, retry_delay=30, retry_max=3600, max_attempts=20, coalesce=0):
+        """Initialise the Outbox, creating its table in the sqlite database at path if needed, and start sending.
+
+        Replies are written to the database before anything is sent, so any
+        that are still queued when makeme stops are sent after it restarts.
+
+        Keyword arguments:
+        path -- sqlite database to keep queued replies in.
+        mail_handler -- MailHandler object to send replies with.
+        ledger -- optional Ledger to mark messages as replied to once their reply is sent. Only replies for its source
+        are sent by this Outbox, so several can share one database.
+        batch_size -- most replies to send each time the queue is emptied.
+        retry_delay -- seconds to wait before retrying a failed reply, doubling on each failure after that.
+        retry_max -- most seconds to wait between retries.
+        max_attempts -- how many times to try sending a reply before giving up on it.
+        coalesce -- seconds to hold a reply for, so any others to the same address in that time are sent with it
+        as one email. 0 sends every reply straight away.
+
+        """
+        self.path = path
+        self.mail_handler = mail_handler
+        self.ledger = ledger
+        self.source = ledger.source if ledger is not None else ''
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.coalesce = coalesce
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._stopping = False
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS replies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            files TEXT NOT NULL,
+            uidvalidity INTEGER,
+            uid INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            source TEXT NOT NULL DEFAULT '',
+            spool TEXT)''')
+
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(replies)')]
+
+        if 'source' not in columns:
+            self._db.execute("ALTER TABLE replies ADD COLUMN source TEXT NOT NULL DEFAULT ''")
+
+        if 'spool' not in columns:
+            self._db.execute('ALTER TABLE replies ADD COLUMN spool TEXT')
+
+        queued = self._db.execute('SELECT COUNT(*) FROM replies WHERE source = ?', (self.source,)).fetchone()[0]
+
+        if queued:
+            logging.info('{} replies left over from last time are queued to be sent'.format(queued))
+
+        self._thread = threading.Thread(target=self._run, name='Outbox', daemon=True)
+        self._thread.start()
+
+    def _due(self):
+        """Return up to batch_size replies that are due to be sent, oldest first."""
+        return self._db.execute('''SELECT id, sender, receiver, subject, body, files, uidvalidity, uid, attempts
+            FROM replies WHERE source = ? AND next_attempt <= ? ORDER BY id LIMIT ?''', (self.source, time.time(), self.batch_size)).fetchall()
+
+    def _failed(self, rows, reason, permanent=False):
+        """Schedule replies that couldn't be sent to be retried, or drop them if they never will be.
+
+        Keyword arguments:
+        rows -- the replies' rows from _due().
+        reason -- description of why they failed, for the log.
+        permanent -- True if retrying can't help, e.g. the address was rejected.
+
+        """
+        for reply_id, sender, receiver, subject, body, files, uidvalidity, uid, attempts in rows:
+            receiver = ', '.join(json.loads(receiver))
+            attempts += 1
+
+            if permanent or attempts >= self.max_attempts:
+                logging.error('Giving up on reply "{}" to {} after {} attempts: {}'.format(subject, receiver, attempts, reason))
+
+                self._remove(reply_id)
+                continue
+
+            delay = min(self.retry_delay * 2 ** (attempts - 1), self.retry_max)
+            logging.warning('Could not send reply to {}, retrying in {} seconds: {}'.format(receiver, delay, reason))
+
+            with self._lock:
+                self._db.execute('UPDATE replies SET attempts = ?, next_attempt = ? WHERE id = ?', (attempts, time.time() + delay, reply_id))
+
+    def _next_attempt(self):
+        """Return the time the next reply is due, or None if the queue is empty."""
+        return self._db.execute('SELECT MIN(next_attempt) FROM replies WHERE source = ?', (self.source,)).fetchone()[0]
+
+    def _remove(self, reply_id):
+        """Delete a reply that has been sent or given up on, along with the directory of files it was keeping.
+
+        Keyword arguments:
+        reply_id -- id of the reply's row.
+
+        """
+        with self._lock:
+            spool = self._db.execute('SELECT spool FROM replies WHERE id = ?', (reply_id,)).fetchone()
+            self._db.execute('DELETE FROM replies WHERE id = ?', (reply_id,))
+
+        if spool and spool[0]:
+            shutil.rmtree(spool[0], ignore_errors=True)
+
+    def _run(self):
+        """Send replies as they become due, until close() is called."""
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    due = self._next_attempt()
+
+                    if due is not None and due <= time.time():
+                        break
+
+                    self._wake.wait(None if due is None else due - time.time())
+
+                if self._stopping:
+                    return
+
+                batch = self._due()
+
+            self._send(batch)
+
+    def _digest(self, rows):
+        """Return a single Email combining the replies in rows, which are all to the same address.
+
+        Keyword arguments:
+        rows -- rows from _due().
+
+        """
+        reply_id, sender, receiver, subject, body, files = rows[0][:6]
+
+        if len(rows) == 1:
+            email = Email(sender=sender, receiver=json.loads(receiver), subject=subject, body=body)
+        else:
+            sections = ['{}\n\n{}'.format(row[3], row[4]) for row in rows]
+            email = Email(sender=sender, receiver=json.loads(receiver), subject='RE: {} commands'.format(len(rows)),
+                    body='\n\n{}\n\n'.format('-' * 40).join(sections))
+
+        for row in rows:
+            for name, path in json.loads(row[5]):
+                if not os.path.isfile(path):
+                    logging.error('Attachment {} for reply to {} has gone, sending without it'.format(path, email.receiver))
+                    continue
+
+                email.attach_file(name, path)
+
+        return email
+
+    def _send(self, batch):
+        """Send a batch of replies over the shared SMTP connection.
+
+        If coalescing, replies in the batch to the same address are sent as one email. If
+        the connection is lost, the rest of the batch is retried later
+        rather than trying every reply against a server that's down.
+
+        Keyword arguments:
+        batch -- rows from _due().
+
+        """
+        groups = collections.OrderedDict()
+
+        for row in batch:
+            key = (row[1], row[2]) if self.coalesce else row[0]
+            groups.setdefault(key, []).append(row)
+
+        groups = list(groups.values())
+
+        for i, rows in enumerate(groups):
+            try:
+                sent = self.mail_handler.send_email(self._digest(rows))
+            except smtplib.SMTPRecipientsRefused as e:
+                self._failed(rows, e, permanent=True)
+                continue
+            except smtplib.SMTPResponseException as e:
+                # 5xx replies mean the server will never accept it.
+                self._failed(rows, e, permanent=e.smtp_code >= 500)
+                continue
+            except smtplib.SMTPException as e:
+                self._failed(rows, e)
+                continue
+            except Exception as e:
+                # e.g. an address that can't be encoded. Retrying won't help, and this thread must keep running.
+                logging.exception('Could not send reply to {}'.format(', '.join(json.loads(rows[0][2]))))
+                self._failed(rows, e, permanent=True)
+                continue
+
+            if not sent:
+                for unsent in groups[i:]:
+                    self._failed(unsent, 'SMTP is unavailable')
+
+                return
+
+            for reply_id, sender, receiver, subject, body, files, uidvalidity, uid, attempts in rows:
+                self._remove(reply_id)
+
+                if self.ledger is not None:
+                    self.ledger.replied(uidvalidity, uid)
+
+    def close(self):
+        """Stop sending and close the database. Replies still queued are kept for next time."""
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+
+        self._thread.join()
+
+        with self._lock:
+            self._db.close()
+
+    def put(self, email, uidvalidity=None, uid=None, spool=None):
+        """Queue email to be sent as soon as possible, or after the coalesce window if one is set.
+
+        Keyword arguments:
+        email -- Email object to send.
+        uidvalidity -- UIDVALIDITY of the mailbox the message being replied to is in.
+        uid -- IMAP UID of the message being replied to, marked as replied once email is sent.
+        spool -- directory to delete once email has been sent or given up on, so files attached from it are
+        still there when it's sent.
+
+        """
+        receiver = json.dumps(email.receiver)
+        now = time.time()
+
+        with self._lock:
+            send_at = now
+
+            if self.coalesce:
+                # join a reply to the same address that's still waiting, or start a new window.
+                waiting = self._db.execute('''SELECT MIN(next_attempt) FROM replies
+                    WHERE source = ? AND sender = ? AND receiver = ? AND attempts = 0 AND next_attempt > ?''',
+                    (self.source, email.sender, receiver, now)).fetchone()[0]
+                send_at = waiting or now + self.coalesce
+
+            self._db.execute('''INSERT INTO replies (sender, receiver, subject, body, files, uidvalidity, uid, next_attempt, source, spool)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (email.sender, receiver, email.subject, email.body, json.dumps(email.files), uidvalidity, uid, send_at, self.source, spool))
+            self._wake.notify()
+
+    def queued(self):
+        """Return how many replies are waiting to be sent."""
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM replies WHERE source = ?', (self.source,)).fetchone()[0]
@@ -0,0 +1,100 @@
+'''
+File: reply.py
+Author: Nathan Hoad
+Description: Builds the reply to a command from the directives its script writes to stdout
+'''
+
+import logging
+import os
+
+from emails import Email
+
+
+class Reply(object):
+    def __init__(self, message, sender, outbox):
+        """Initialise a Reply to message, which by default goes back to whoever sent it.
+
+        Scripts change the reply by writing directives to stdout, one per
+        line. A directive is a name, then its argument:
+
+        attach_file PATH -- attach the file at PATH to the reply.
+        change_reply_address ADDRESS -- send the reply to ADDRESS instead.
+        set_subject TEXT -- use TEXT as the reply's subject.
+        progress TEXT -- send TEXT as a reply straight away, while the script keeps running.
+
+        Any other line is ignored, so scripts can print what they like.
+
+        Keyword arguments:
+        message -- Email object the script is being run for.
+        sender -- address replies are sent from.
+        outbox -- Outbox to queue replies in.
+
+        """
+        self.message = message
+        self.sender = sender
+        self.outbox = outbox
+        self.receiver = message.sender
+        self.subject = 'RE: {}'.format(message.subject)
+        self.files = []
+
+    def attach_file(self, path):
+        """Attach the file at path, relative to the current directory."""
+        path = os.path.abspath(path)
+
+        if not os.path.isfile(path):
+            logging.error('Script asked to attach {}, which does not exist'.format(path))
+            return
+
+        self.files.append((os.path.basename(path), path))
+
+    def change_reply_address(self, address):
+        """Send the reply to address instead of the command's sender."""
+        self.receiver = address
+
+    def feed(self, line):
+        """Act on a line of the script's stdout, if it's a directive.
+
+        Keyword arguments:
+        line -- one line of output, without its line break.
+
+        """
+        name, _, argument = line.strip().partition(' ')
+        argument = argument.strip()
+        directive = self.DIRECTIVES.get(name.lower())
+
+        if directive is None or not argument:
+            logging.debug('Ignoring script output {!r}'.format(line))
+            return
+
+        directive(self, argument)
+
+    def progress(self, text):
+        """Send text as a reply now, without waiting for the script to finish."""
+        self.outbox.put(Email(sender=self.sender, receiver=self.receiver, subject=self.subject, body=text))
+
+    def send(self, body):
+        """Queue the final reply, with body as its text, and mark the message as replied once it's sent.
+
+        Keyword arguments:
+        body -- text of the reply.
+
+        """
+        email = Email(sender=self.sender, receiver=self.receiver, subject=self.subject, body=body)
+
+        for name, path in self.files:
+            email.attach_file(name, path)
+
+        # the outbox deletes the message's attachments once the reply is sent, since it may be sending some of them.
+        self.outbox.put(email, self.message.uidvalidity, self.message.uid, self.message.spool)
+        self.message.spool = None
+
+    def set_subject(self, subject):
+        """Use subject as the reply's subject."""
+        self.subject = subject
+
+    DIRECTIVES = {
+        'attach_file': attach_file,
+        'change_reply_address': change_reply_address,
+        'set_subject': set_subject,
+        'progress': progress,
+    }
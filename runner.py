@@ -0,0 +1,343 @@
+'''
+File: runner.py
+Author: Nathan Hoad
+Description: Runs scripts and collects their output
+'''
+
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+
+from threading import Thread
+
+from warm import Zygote
+
+
+class ScriptTimeout(Exception):
+    def __init__(self, script, timeout, stdout, stderr):
+        """Initialise ScriptTimeout with whatever the script wrote before it was killed.
+
+        Keyword arguments:
+        script -- name of the script that timed out.
+        timeout -- seconds it was allowed to run for.
+        stdout -- its output to stdout, as a string.
+        stderr -- its output to stderr, as a string.
+
+        """
+        Exception.__init__(self, '{} timed out after {} seconds'.format(script, timeout))
+
+        self.script = script
+        self.timeout = timeout
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class OutputBuffer(object):
+    # bytes read from a pipe at a time.
+    CHUNK_SIZE = 65536
+    # longest line passed to on_line. Anything longer can't be a directive, so it's skipped.
+    MAX_LINE = 65536
+
+    def __init__(self, max_size, spill_size, on_line=None):
+        """Initialise an OutputBuffer.
+
+        Output is kept in memory until it passes spill_size, after which it
+        moves to a temporary file. Anything past max_size is thrown away.
+
+        Keyword arguments:
+        max_size -- most bytes of output to keep. 0 keeps everything.
+        spill_size -- bytes to hold in memory before moving to a temporary file.
+        on_line -- optional function called with each line of output as a string, as soon as the line is complete.
+
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.on_line = on_line
+        self._line = b''
+        # set while skipping the rest of a line that got too long, until its line break.
+        self._discarding = False
+        self._file = tempfile.SpooledTemporaryFile(max_size=spill_size)
+
+    def _feed(self, data):
+        """Pass each complete line in data to on_line, keeping any partial line for next time.
+
+        Keyword arguments:
+        data -- bytes just read, or None at the end of the output to pass on the last line.
+
+        """
+        if data is None:
+            lines = [self._line] if self._line and not self._discarding else []
+            self._line, self._discarding = b'', False
+        else:
+            *lines, self._line = (self._line + data).split(b'\n')
+
+            # the first line is the end of the one that was too long.
+            if self._discarding and lines:
+                lines.pop(0)
+                self._discarding = False
+
+            if len(self._line) > self.MAX_LINE:
+                self._line, self._discarding = b'', True
+
+        for line in lines:
+            if len(line) > self.MAX_LINE:
+                continue
+
+            try:
+                self.on_line(str(line, encoding='utf8', errors='replace').rstrip('\r'))
+            except Exception:
+                logging.exception('Handling output line {!r} failed'.format(line))
+
+    def close(self):
+        """Throw away the output, deleting any temporary file."""
+        self._file.close()
+
+    def getvalue(self):
+        """Return the output as a string, noting how much was thrown away if it was too big."""
+        self._file.seek(0)
+        text = str(self._file.read(), encoding='utf8', errors='replace')
+
+        if self.max_size and self.size > self.max_size:
+            text += '\n[output truncated, {} bytes omitted]\n'.format(self.size - self.max_size)
+
+        return text
+
+    def pump(self, stream):
+        """Read stream until it closes, keeping as much as max_size allows.
+
+        Keyword arguments:
+        stream -- binary file object to read, such as a pipe.
+
+        """
+        while True:
+            data = stream.read1(self.CHUNK_SIZE) if hasattr(stream, 'read1') else stream.read(self.CHUNK_SIZE)
+
+            if not data:
+                break
+
+            self.write(data)
+
+        if self.on_line is not None:
+            self._feed(None)
+
+        stream.close()
+
+    async def pump_async(self, stream):
+        """Read an asyncio stream until it closes, keeping as much as max_size allows.
+
+        Keyword arguments:
+        stream -- asyncio.StreamReader to read, such as a subprocess pipe.
+
+        """
+        while True:
+            data = await stream.read(self.CHUNK_SIZE)
+
+            if not data:
+                break
+
+            self.write(data)
+
+        if self.on_line is not None:
+            self._feed(None)
+
+    def write(self, data):
+        """Add data to the output, dropping whatever doesn't fit under max_size.
+
+        Keyword arguments:
+        data -- bytes to add.
+
+        """
+        keep = len(data)
+
+        if self.max_size:
+            keep = max(0, min(keep, self.max_size - self.size))
+
+        if keep:
+            self._file.write(data[:keep])
+
+        self.size += len(data)
+
+        if self.on_line is not None:
+            self._feed(data)
+
+
+class ScriptRunner(object):
+    # seconds between asking a timed out script to stop and killing it.
+    KILL_GRACE = 5
+
+    def __init__(self, directory, max_output=1048576, spill_size=65536):
+        """Initialise a ScriptRunner for the scripts in directory.
+
+        Keyword arguments:
+        directory -- directory the scripts live in.
+        max_output -- most bytes of stdout or stderr to keep from a script. 0 keeps everything.
+        spill_size -- bytes of output to hold in memory before moving it to a temporary file.
+
+        """
+        self.directory = directory
+        self.max_output = max_output
+        self.spill_size = spill_size
+        self._zygote = None
+
+    def _kill(self, pipe):
+        """Terminate the process group pipe leads, killing it if it won't go quietly."""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pipe.pid, sig)
+            except ProcessLookupError:
+                return
+
+            try:
+                pipe.wait(self.KILL_GRACE)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+    async def _kill_async(self, process):
+        """Terminate the process group process leads, killing it if it won't go quietly."""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+
+            try:
+                await asyncio.wait_for(process.wait(), self.KILL_GRACE)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def close(self):
+        """Stop the warm script zygote, if it was started."""
+        if self._zygote is not None:
+            self._zygote.close()
+            self._zygote = None
+
+    def start_warm(self, modules=()):
+        """Start the zygote that warm scripts are forked from. Call this before starting any threads.
+
+        Keyword arguments:
+        modules -- names of modules to import in the zygote, so warm scripts don't have to.
+
+        """
+        self._zygote = Zygote(modules)
+
+    def run(self, script, args, timeout=None, warm=False, on_line=None):
+        """Run script and wait for it to finish. Return (returncode, stdout, stderr).
+
+        stdout and stderr are read while the script runs, so it can't block
+        on a full pipe no matter how much it writes. The script runs in its
+        own process group, so anything it starts is killed along with it.
+
+        Keyword arguments:
+        script -- name of the script in directory.
+        args -- argument list for the script, starting with argv[0].
+        timeout -- seconds to let the script run before killing it and raising ScriptTimeout. None or 0 waits forever.
+        warm -- run the script, which must be Python 3, in a fork of the zygote instead of a new interpreter.
+        on_line -- optional function called with each line the script writes to stdout, while it's still running.
+
+        """
+        command = os.path.join(self.directory, script)
+        pipe = None
+
+        if warm and self._zygote is not None:
+            try:
+                pipe = self._zygote.spawn(command, args)
+            except OSError as e:
+                logging.error('Could not start {} warm, starting it normally: {}'.format(command, e))
+
+        if pipe is None:
+            pipe = subprocess.Popen(args, executable=command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+        out = OutputBuffer(self.max_output, self.spill_size, on_line)
+        err = OutputBuffer(self.max_output, self.spill_size)
+        readers = [Thread(target=out.pump, args=(pipe.stdout,), daemon=True), Thread(target=err.pump, args=(pipe.stderr,), daemon=True)]
+
+        for reader in readers:
+            reader.start()
+
+        timed_out = False
+
+        try:
+            pipe.wait(timeout or None)
+        except subprocess.TimeoutExpired:
+            logging.error('{} timed out after {} seconds, killing it'.format(command, timeout))
+            timed_out = True
+            self._kill(pipe)
+
+        for reader in readers:
+            # something that escaped the process group could hold the pipes open forever.
+            reader.join(self.KILL_GRACE if timed_out else None)
+
+        logging.info('Popen for {} is complete'.format(command))
+
+        try:
+            if timed_out:
+                raise ScriptTimeout(script, timeout, out.getvalue(), err.getvalue())
+
+            return pipe.returncode, out.getvalue(), err.getvalue()
+        finally:
+            out.close()
+            err.close()
+
+    async def run_async(self, script, args, timeout=None, warm=False, on_line=None):
+        """Coroutine version of run(), for use with the asyncio engine.
+
+        If the coroutine is cancelled, the script is killed before the
+        cancellation is passed on. Warm scripts are handed to run() in the
+        loop's executor instead.
+
+        Keyword arguments:
+        script -- name of the script in directory.
+        args -- argument list for the script, starting with argv[0].
+        timeout -- seconds to let the script run before killing it and raising ScriptTimeout. None or 0 waits forever.
+        warm -- run the script, which must be Python 3, in a fork of the zygote instead of a new interpreter.
+        on_line -- optional function called with each line the script writes to stdout, while it's still running.
+
+        """
+        if warm and self._zygote is not None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.run, script, args, timeout, warm, on_line)
+
+        command = os.path.join(self.directory, script)
+
+        process = await asyncio.create_subprocess_exec(*args, executable=command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+        out = OutputBuffer(self.max_output, self.spill_size, on_line)
+        err = OutputBuffer(self.max_output, self.spill_size)
+        readers = asyncio.gather(out.pump_async(process.stdout), err.pump_async(process.stderr))
+
+        timed_out = False
+
+        try:
+            await asyncio.wait_for(process.wait(), timeout or None)
+        except asyncio.TimeoutError:
+            logging.error('{} timed out after {} seconds, killing it'.format(command, timeout))
+            timed_out = True
+            await self._kill_async(process)
+        except asyncio.CancelledError:
+            await self._kill_async(process)
+            readers.cancel()
+            out.close()
+            err.close()
+            raise
+
+        try:
+            # something that escaped the process group could hold the pipes open forever.
+            await asyncio.wait_for(readers, self.KILL_GRACE if timed_out else None)
+        except asyncio.TimeoutError:
+            pass
+
+        logging.info('Subprocess for {} is complete'.format(command))
+
+        try:
+            if timed_out:
+                raise ScriptTimeout(script, timeout, out.getvalue(), err.getvalue())
+
+            return process.returncode, out.getvalue(), err.getvalue()
+        finally:
+            out.close()
+            err.close()
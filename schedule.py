@@ -0,0 +1,195 @@
+'''
+File: schedule.py
+Author: Nathan Hoad
+Description: Works out when to next check for messages from the refresh_time setting
+'''
+
+import time
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+class Interval(object):
+    def __init__(self, seconds):
+        """Initialise an Interval that fires every seconds, starting from now.
+
+        Fire times are kept on a fixed grid from the start time, on the
+        monotonic clock, so a slow check doesn't push every later one back.
+
+        Keyword arguments:
+        seconds -- time between each fire.
+
+        """
+        self.seconds = seconds
+        self._next = time.monotonic() + seconds
+
+    def delay(self, now, wall):
+        """Return seconds until the next fire. Fires that were missed are skipped rather than run back to back.
+
+        Keyword arguments:
+        now -- current time.monotonic().
+        wall -- current time.time().
+
+        """
+        if self._next <= now:
+            missed = (now - self._next) // self.seconds + 1
+            self._next += missed * self.seconds
+
+        return self._next - now
+
+
+class Minutes(object):
+    def __init__(self, minutes):
+        """Initialise Minutes, which fires at each of the given minutes past every hour, local time.
+
+        Keyword arguments:
+        minutes -- iterable of minutes past the hour, 0-59.
+
+        """
+        self.minutes = sorted(set(minutes))
+
+    def delay(self, now, wall):
+        """Return seconds until the next of the minutes past the hour, never 0.
+
+        Keyword arguments:
+        now -- current time.monotonic().
+        wall -- current time.time().
+
+        """
+        local = time.localtime(wall)
+        hour = wall - local.tm_min * 60 - local.tm_sec - wall % 1
+
+        for minute in self.minutes:
+            if hour + minute * 60 > wall:
+                return hour + minute * 60 - wall
+
+        return hour + 3600 + self.minutes[0] * 60 - wall
+
+
+class Adaptive(object):
+    def __init__(self, minimum, maximum):
+        """Initialise an Adaptive slot, which checks often while commands are arriving and backs off when they stop.
+
+        Keyword arguments:
+        minimum -- seconds between checks right after a command arrives.
+        maximum -- most seconds between checks when nothing is arriving.
+
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.seconds = maximum
+
+    def delay(self, now, wall):
+        """Return seconds until the next check.
+
+        Keyword arguments:
+        now -- current time.monotonic().
+        wall -- current time.time().
+
+        """
+        return self.seconds
+
+    def observe(self, found):
+        """Drop to the minimum wait if the last check found commands, otherwise double the wait up to the maximum.
+
+        Keyword arguments:
+        found -- how many messages the last check found.
+
+        """
+        if found:
+            self.seconds = self.minimum
+        else:
+            self.seconds = min(self.seconds * 2, self.maximum)
+
+
+class Schedule(object):
+    # seconds in each unit prefix, no prefix means minutes.
+    UNITS = {'s': 1, '': 60, 'h': 3600}
+
+    def __init__(self, expression, minimum=0, maximum=0):
+        """Parse a refresh_time expression into a Schedule.
+
+        An expression is one or more slots separated by commas, and the
+        schedule fires at whichever slot comes first. A slot is N minutes,
+        hN hours or sN seconds between checks, :N for N minutes past every
+        hour, or /N for every N minutes on the clock, e.g. 9:10, 9:20.
+
+        If minimum is given the expression is ignored, and the wait adapts
+        between minimum and maximum to how often commands arrive instead.
+
+        Keyword arguments:
+        expression -- the refresh_time setting.
+        minimum -- seconds between checks right after a command arrives, or 0 to use expression.
+        maximum -- most seconds between checks when nothing is arriving.
+
+        """
+        self.expression = expression
+        self.adaptive = None
+
+        if minimum:
+            if maximum < minimum:
+                raise ScheduleError('poll_max must be at least poll_min')
+
+            self.adaptive = Adaptive(minimum, maximum)
+            self.slots = [self.adaptive]
+        else:
+            self.slots = [self._parse(slot.strip()) for slot in str(expression).split(',')]
+
+    def _parse(self, slot):
+        """Return the Interval or Minutes object for a single slot of the expression.
+
+        Keyword arguments:
+        slot -- one comma separated part of the expression.
+
+        """
+        prefix, number = (slot[:1], slot[1:]) if slot[:1] in 'sh:/' else ('', slot)
+
+        if not number.isdigit():
+            raise ScheduleError('refresh_time {!r} is not a valid time'.format(slot))
+
+        number = int(number)
+
+        if prefix == ':':
+            if number > 59:
+                raise ScheduleError('refresh_time {!r} must be between :0 and :59'.format(slot))
+
+            return Minutes([number])
+
+        if number == 0:
+            raise ScheduleError('refresh_time {!r} must be more than 0'.format(slot))
+
+        if prefix == '/':
+            if number > 60:
+                raise ScheduleError('refresh_time {!r} must be between /1 and /60'.format(slot))
+
+            return Minutes(range(0, 60, number))
+
+        return Interval(number * self.UNITS[prefix])
+
+    def delay(self):
+        """Return seconds until the next check is due."""
+        now = time.monotonic()
+        wall = time.time()
+
+        return min(slot.delay(now, wall) for slot in self.slots)
+
+    def observe(self, found):
+        """Tell the schedule how many messages the last check found, for adaptive polling.
+
+        Keyword arguments:
+        found -- how many messages the last check found.
+
+        """
+        if self.adaptive is not None:
+            self.adaptive.observe(found)
+
+    def wait(self, stopped):
+        """Wait until the next check is due. Return True if stopped was set first.
+
+        Keyword arguments:
+        stopped -- threading.Event set when the server is stopping.
+
+        """
+        return stopped.wait(self.delay())
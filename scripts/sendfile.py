@@ -14,4 +14,4 @@ if result:
 
     # prevent the user from sending the config file to themselves.
     if filename not in restricted_names:
-        print('attach_file {0}'.format(filename)
+        print('attach_file {0}'.format(filename))
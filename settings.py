@@ -0,0 +1,207 @@
+'''
+File: settings.py
+Author: Nathan Hoad
+Description: Parses and checks the [settings] section of makeme.conf
+'''
+
+import collections
+import configparser
+import logging
+import os
+
+from schedule import Schedule, ScheduleError
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def _boolean(value):
+    """Return value as a bool, accepting the same words as configparser."""
+    try:
+        return configparser.RawConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError('not a boolean') from None
+
+
+def _count(value):
+    """Return value as an int that's 0 or more."""
+    number = int(value)
+
+    if number < 0:
+        raise ValueError('negative')
+
+    return number
+
+
+def _port(value):
+    """Return value as an int that's a valid port number."""
+    number = int(value)
+
+    if not 0 < number < 65536:
+        raise ValueError('out of range')
+
+    return number
+
+
+def _choice(*choices):
+    """Return a function that checks its value is one of choices, ignoring case."""
+    def check(value):
+        if value.lower() not in choices:
+            raise ValueError('not one of ' + ', '.join(choices))
+
+        return value.lower()
+
+    return check
+
+
+def _names(value):
+    """Return a comma or space separated list of names as a tuple."""
+    return tuple(value.replace(',', ' ').split())
+
+
+def _list(value):
+    """Return a comma separated list as a tuple, so items can contain spaces."""
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def _ascii_list(value):
+    """Return a comma separated list as a tuple, checking it's plain ASCII so it can be sent to IMAP as is."""
+    items = _list(value)
+
+    if not all(item.isascii() for item in items):
+        raise ValueError('only plain ASCII is supported')
+
+    return items
+
+
+def _text(value):
+    """Return value unchanged."""
+    return value
+
+
+# every setting, with the function that converts it from text and its default. None means it must be set.
+SETTINGS = collections.OrderedDict([
+    ('username', (_text, None)),
+    ('password', (_text, None)),
+    ('smtp_server', (_text, 'smtp.gmail.com')),
+    ('smtp_port', (_port, '587')),
+    ('smtp_tls', (_boolean, 'yes')),
+    ('imap_server', (_text, 'imap.gmail.com')),
+    ('imap_port', (_port, '993')),
+    ('imap_ssl', (_boolean, 'yes')),
+    ('mailboxes', (_list, 'INBOX')),
+    ('search_from', (_ascii_list, '')),
+    ('search_subject', (_ascii_list, '')),
+    ('search_since', (_count, '0')),
+    ('allowed_senders', (_list, '')),
+    ('require_dkim', (_boolean, 'no')),
+    ('auth_servers', (_names, '')),
+    ('auth_secret', (_text, '')),
+    ('auth_window', (_count, '900')),
+    ('sent_welcome_message', (_boolean, 'no')),
+    ('fork', (_boolean, 'no')),
+    ('refresh_time', (_text, '5')),
+    ('poll_min', (_count, '0')),
+    ('poll_max', (_count, '900')),
+    ('idle', (_boolean, 'yes')),
+    ('reconnect_attempts', (_count, '5')),
+    ('reconnect_delay', (_count, '2')),
+    ('fetch_chunk_size', (_count, '50')),
+    ('preview_size', (_count, '16384')),
+    ('max_workers', (_count, '4')),
+    ('max_reply_size', (_count, '1048576')),
+    ('script_timeout', (_count, '300')),
+    ('engine', (_choice('threads', 'asyncio'), 'threads')),
+    ('warm_modules', (_names, '')),
+    ('spool_dir', (_text, '')),
+    ('reply_batch_size', (_count, '20')),
+    ('reply_retry_delay', (_count, '30')),
+    ('reply_retry_max', (_count, '3600')),
+    ('reply_attempts', (_count, '20')),
+    ('reply_coalesce', (_count, '0')),
+    ('monitor_config', (_boolean, 'no')),
+    ('log_file', (_text, os.path.join(os.environ['HOME'], '.makeme/makeme.log'))),
+    ('ledger_file', (_text, os.path.join(os.environ['HOME'], '.makeme/ledger.db'))),
+    ('log_format', (_text, '[%(asctime)s] %(levelname)s: %(message)s')),
+    ('log_level', (_choice('debug', 'info', 'warning', 'error', 'critical'), 'info')),
+    ('date_format', (_text, '%Y-%m-%d %H:%M:%S')),
+])
+
+# settings that an [account NAME] section can set for itself. The rest are shared by every account.
+ACCOUNT_SETTINGS = ('username', 'password', 'smtp_server', 'smtp_port', 'smtp_tls', 'imap_server', 'imap_port', 'imap_ssl', 'mailboxes',
+        'search_from', 'search_subject', 'search_since', 'allowed_senders', 'require_dkim', 'auth_servers', 'auth_secret',
+        'auth_window')
+# account settings that fall back to their default rather than to [settings], so accounts don't watch each other's folders.
+NOT_INHERITED = ('mailboxes',)
+
+
+class Settings(collections.namedtuple('Settings', SETTINGS)):
+    """Every setting from [settings], converted to its proper type. Immutable, so it can be shared between threads."""
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config, section='settings', base=None):
+        """Return Settings read from config, raising SettingsError if any are missing or invalid.
+
+        Keyword arguments:
+        config -- RawConfigParser to read from.
+        section -- section of config to read.
+        base -- Settings of the main account. If given, section is an account, which may only set ACCOUNT_SETTINGS and
+        takes everything it doesn't set from base.
+
+        """
+        if not config.has_section(section):
+            raise SettingsError('there is no [{}] section'.format(section))
+
+        if base is not None:
+            for name in config.options(section):
+                if name not in ACCOUNT_SETTINGS and name not in config.defaults():
+                    raise SettingsError('{} can\'t be set in [{}], only in [settings]'.format(name, section))
+
+        values = {}
+
+        for name, (convert, default) in SETTINGS.items():
+            if config.has_option(section, name):
+                value = config.get(section, name)
+            elif base is not None and name not in NOT_INHERITED:
+                values[name] = getattr(base, name)
+                continue
+            elif default is None:
+                raise SettingsError('{} must be set'.format(name))
+            else:
+                value = default
+
+            if base is not None and name not in ACCOUNT_SETTINGS:
+                values[name] = getattr(base, name)
+                continue
+
+            try:
+                values[name] = convert(value)
+            except ValueError as e:
+                raise SettingsError('{} = {} is not valid ({})'.format(name, value, e)) from None
+
+        settings = cls(**values)
+
+        if not settings.mailboxes:
+            raise SettingsError('mailboxes must name at least one mailbox')
+
+        if settings.require_dkim and not settings.auth_servers:
+            raise SettingsError('auth_servers must be set to use require_dkim, or anyone could forge the results')
+
+        for name in ('max_workers', 'fetch_chunk_size', 'reply_batch_size'):
+            if getattr(settings, name) == 0:
+                raise SettingsError('{} must be at least 1'.format(name))
+
+        try:
+            # checked now rather than the first time it's needed.
+            Schedule(settings.refresh_time, settings.poll_min, settings.poll_max)
+        except ScheduleError as e:
+            raise SettingsError(str(e)) from None
+
+        return settings
+
+    @property
+    def level(self):
+        """Return log_level as a logging level."""
+        return getattr(logging, self.log_level.upper())
@@ -1,26 +1,116 @@
 #!/usr/bin/env python
 
+import collections
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
 from threading import Thread
 
 class MessageProcessor(Thread):
-    def __init__(self, email_client, action):
-        """Initialise MessageProcessor and store email_client and action.
+    def __init__(self, email_client, action, wanted=None, pool=None, ledger=None):
+        """Initialise MessageProcessor and store email_client, action, wanted, pool and ledger.
 
         Keyword arguments:
-        email_client -- factory function to create a MailHandler object.
+        email_client -- MailHandler object, shared between runs so its connections are reused.
         action -- function to be called on each message.
+        wanted -- optional function called on a preview of each message, returning False if it can be skipped.
+        pool -- optional WorkerPool to call action in. Without one, messages are handled one at a time.
+        ledger -- optional Ledger used to make sure no message is queued twice. action must claim each message from it.
 
         """
         Thread.__init__(self)
 
         self.email_client = email_client
         self.action = action
+        self.wanted = wanted
+        self.pool = pool
+        self.ledger = ledger
+        # set once messages have been fetched, with found being how many there were.
+        self.fetched = threading.Event()
+        self.found = 0
 
     def run(self):
         """Check for emails using self.email_client and call self.action on each one."""
-        e = self.email_client()
+        e = self.email_client
 
-        messages = e.get_messages()
+        try:
+            messages = e.get_messages(self.wanted, self.ledger)
+            self.found = len(messages)
+        finally:
+            self.fetched.set()
 
         for m in messages:
-            self.action(e, m)
+            if self.ledger is not None and not self.ledger.queue(m.uidvalidity, m.uid):
+                logging.info('Message {} is already queued, skipping'.format(m.uid))
+                m.cleanup()
+                continue
+
+            if self.pool is None:
+                self.action(e, m)
+            else:
+                # messages from the same sender are run in the order they arrived.
+                self.pool.submit(parseaddr(m.sender)[1].lower(), self.action, e, m)
+
+
+class WorkerPool(object):
+    def __init__(self, max_workers):
+        """Initialise a WorkerPool that runs at most max_workers jobs at once.
+
+        Jobs submitted with the same key are run one after another, in the
+        order they were submitted. Jobs with different keys run in parallel.
+
+        Keyword arguments:
+        max_workers -- most jobs to run at the same time.
+
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='Worker')
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def _run(self, key, function, args):
+        """Call function, then every job queued behind it for key."""
+        while True:
+            try:
+                function(*args)
+            except Exception:
+                logging.exception('Job for {} failed'.format(key))
+
+            with self._lock:
+                queue = self._queues[key]
+
+                if not queue:
+                    del self._queues[key]
+                    return
+
+                function, args = queue.popleft()
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs.
+
+        Keyword arguments:
+        wait -- whether to block until running and queued jobs have finished.
+
+        """
+        self._executor.shutdown(wait=wait)
+
+    def submit(self, key, function, *args):
+        """Call function(*args) in the pool once every earlier job for key has finished.
+
+        Keyword arguments:
+        key -- jobs sharing a key are run in order, one at a time.
+        function -- the job to run.
+
+        """
+        with self._lock:
+            queue = self._queues.get(key)
+
+            # a worker is already running jobs for key, it'll get to this one.
+            if queue is not None:
+                queue.append((function, args))
+                return
+
+            self._queues[key] = collections.deque()
+
+        self._executor.submit(self._run, key, function, args)
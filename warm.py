@@ -0,0 +1,249 @@
+'''
+File: warm.py
+Author: Nathan Hoad
+Description: Runs Python scripts from a pre-forked interpreter
+'''
+
+import importlib
+import json
+import logging
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+
+
+class Zygote(object):
+    def __init__(self, modules=()):
+        """Fork the zygote, a process that imports modules once and then forks a copy of itself per script.
+
+        This must be done before any other threads are started, because only
+        the forking thread survives in the child.
+
+        Keyword arguments:
+        modules -- names of modules to import up front, so scripts find them already loaded.
+
+        """
+        self._lock = threading.Lock()
+        self._control, child = socket.socketpair()
+
+        self.pid = os.fork()
+
+        if self.pid == 0:
+            try:
+                self._control.close()
+                self._serve(child, modules)
+            finally:
+                os._exit(0)
+
+        child.close()
+        logging.info('Started warm script zygote {}'.format(self.pid))
+
+    def _serve(self, control, modules):
+        """Fork a runner for every request on control, until it's closed. Only called in the zygote."""
+        # ctrl-c is for the daemon. The zygote goes when its control socket closes.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # nothing waits for the runners, so let the kernel reap them.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                logging.error('Could not preload {}: {}'.format(name, e))
+
+        while True:
+            try:
+                data, fds, flags, address = socket.recv_fds(control, 1, 3)
+            except OSError:
+                break
+
+            if not data:
+                break
+
+            if os.fork() == 0:
+                try:
+                    control.close()
+                    self._wait_for_script(*fds)
+                finally:
+                    os._exit(0)
+
+            for fd in fds:
+                os.close(fd)
+
+    def _wait_for_script(self, stdout, stderr, channel):
+        """Read a request from channel, fork the script and report its pid and exit status. Only called in a runner."""
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        channel = socket.socket(fileno=channel)
+        request = b''
+
+        while True:
+            data = channel.recv(65536)
+
+            if not data:
+                break
+
+            request += data
+
+        request = json.loads(str(request, encoding='utf8'))
+
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                channel.close()
+                self._run_script(request, stdout, stderr)
+            finally:
+                os._exit(1)
+
+        os.close(stdout)
+        os.close(stderr)
+        channel.sendall('{}\n'.format(pid).encode())
+
+        pid, status = os.waitpid(pid, 0)
+        channel.sendall('{}\n'.format(os.waitstatus_to_exitcode(status)).encode())
+
+    def _run_script(self, request, stdout, stderr):
+        """Run the script in request as __main__ with stdout and stderr as fds 1 and 2. Only called in a script."""
+        os.setsid()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+
+        for fd in (devnull, stdout, stderr):
+            os.close(fd)
+
+        path = request['path']
+
+        os.chdir(request['cwd'])
+        sys.argv = request['argv']
+        sys.path.insert(0, os.path.dirname(path))
+
+        code = 0
+
+        try:
+            # like a script started through its #! line, argv[0] becomes the path.
+            runpy.run_path(path, run_name='__main__')
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+    def close(self):
+        """Stop the zygote. Scripts that are already running carry on."""
+        self._control.close()
+
+        try:
+            os.waitpid(self.pid, 0)
+        except ChildProcessError:
+            pass
+
+    def spawn(self, path, args):
+        """Start the Python script at path with args as its argv. Return a WarmProcess for it.
+
+        Raises OSError if the zygote can't be reached.
+
+        Keyword arguments:
+        path -- path to the script.
+        args -- argument list for the script, starting with argv[0].
+
+        """
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        channel, remote = socket.socketpair()
+
+        try:
+            with self._lock:
+                socket.send_fds(self._control, [b'r'], [out_w, err_w, remote.fileno()])
+        except OSError:
+            for fd in (out_r, err_r):
+                os.close(fd)
+
+            channel.close()
+            raise
+        finally:
+            for fd in (out_w, err_w):
+                os.close(fd)
+
+            remote.close()
+
+        request = {'path': path, 'argv': list(args), 'cwd': os.getcwd()}
+        channel.sendall(json.dumps(request).encode())
+        channel.shutdown(socket.SHUT_WR)
+
+        return WarmProcess(path, channel, os.fdopen(out_r, 'rb'), os.fdopen(err_r, 'rb'))
+
+
+class WarmProcess(object):
+    def __init__(self, path, channel, stdout, stderr):
+        """Initialise a WarmProcess. It behaves enough like a Popen object for ScriptRunner to use.
+
+        Keyword arguments:
+        path -- path to the script, for error messages.
+        channel -- socket the zygote's runner reports the pid and exit status on.
+        stdout -- binary file to read the script's stdout from.
+        stderr -- binary file to read the script's stderr from.
+
+        """
+        self.args = path
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._channel = channel
+        self._buffer = b''
+
+        self.pid = int(self._readline())
+
+    def _readline(self):
+        """Return the next line from the channel, or b'' if it closed first."""
+        while b'\n' not in self._buffer:
+            data = self._channel.recv(64)
+
+            if not data:
+                return b''
+
+            self._buffer += data
+
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line
+
+    def wait(self, timeout=None):
+        """Wait for the script to finish and return its exit status, like Popen.wait.
+
+        Keyword arguments:
+        timeout -- seconds to wait before raising subprocess.TimeoutExpired. None waits forever.
+
+        """
+        if self.returncode is not None:
+            return self.returncode
+
+        if b'\n' not in self._buffer:
+            readable, _, _ = select.select([self._channel], [], [], timeout)
+
+            if not readable:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+
+        line = self._readline()
+        # the runner only goes away without reporting if it was killed itself.
+        self.returncode = int(line) if line else -signal.SIGKILL
+        self._channel.close()
+
+        return self.returncode